@@ -5,5 +5,14 @@ PARAMS = {
     "omit_edges_read_length" : True,
     # IF OMIT_EDGES = True and OMIT_EDGES_READ_LENGTH = False
     # use this value as the length of the edges to omit
-    "omit_edges_length" : 300
+    "omit_edges_length" : 300,
+    # number of randomly placed windows in the non-TE regions used to estimate the genome coverage depth
+    # 0 uses the depth of every non-TE position
+    "genome_depth_windows" : 0,
+    # length of each window used to estimate the genome coverage depth
+    "genome_depth_window_length" : 10000,
+    # resolution of the coverage plots
+    "plot_dpi" : 300,
+    # file format of the coverage plots (png, svg, pdf)
+    "plot_format" : "png"
 }
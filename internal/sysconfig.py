@@ -1,6 +1,5 @@
 ALL_METHODS = ["ngs_te_mapper", "ngs_te_mapper2", "relocate", "relocate2", "temp", "temp2", "retroseq", "popoolationte", "popoolationte2", "te-locate", "teflon", "coverage", "trimgalore","map_reads", "tebreak"]
 SINGLE_END_METHODS = ["ngs_te_mapper", "ngs_te_mapper2", "relocate", "coverage", "trimgalore", "map_reads", "tebreak"]
-MULTI_THREAD_METHODS = ["coverage", "temp", "temp2", "relocate2", "ngs_te_mapper", "ngs_te_mapper2", "popoolationte", "teflon", "trimgalore", "tebreak"]
 NO_INSTALL_METHODS = ["trimgalore", "map_reads", "coverage", "relocate2"] # no source code to install for these methods, just envs
 
 INPUT_DIR = "{{indir}}"
@@ -48,6 +47,173 @@ CONFIG_RULES = {
         "tebreak": ["tebreak_run", "tebreak_post"]
 }
 
+# per-rule resource profiles used to set the threads and memory (mem_mb) of each rule
+# threads: None = rule can use multiple threads, otherwise the max threads the rule can use
+# mem_mb: expected peak memory of the rule
+RULE_RESOURCES = {
+        "processing": {
+                "setup_reads": {"threads": None, "mem_mb": 2000},
+                "trimgalore_multiqc": {"threads": 1, "mem_mb": 2000},
+                "make_coverage_fasta": {"threads": 1, "mem_mb": 1000},
+                "make_reference_fasta": {"threads": 1, "mem_mb": 2000},
+                "make_consensus_fasta": {"threads": 1, "mem_mb": 1000},
+                "make_te_annotations": {"threads": None, "mem_mb": 4000},
+                "mask_reference_fasta": {"threads": 1, "mem_mb": 2000},
+                "make_ref_te_fasta": {"threads": 1, "mem_mb": 2000},
+                "index_reference_genome": {"threads": 1, "mem_mb": 6000},
+                "map_reads": {"threads": None, "mem_mb": 8000},
+                "bam_to_sam": {"threads": None, "mem_mb": 1000},
+                "cram_to_bam": {"threads": None, "mem_mb": 1000},
+                "make_ref_te_bed": {"threads": 1, "mem_mb": 1000},
+                "median_insert_size": {"threads": 1, "mem_mb": 2000},
+                "reference_2bit": {"threads": 1, "mem_mb": 2000},
+                "repeatmask": {"threads": None, "mem_mb": 4000},
+                "summary_report": {"threads": None, "mem_mb": 4000},
+                "cleanup_method": {"threads": 2, "mem_mb": 500},
+                "ref_te_reads": {"threads": 1, "mem_mb": 1000},
+                "scatter_bam": {"threads": 1, "mem_mb": 1000}
+        },
+        "coverage": {
+                "coverage": {"threads": None, "mem_mb": 6000}
+        },
+        "ngs_te_mapper": {
+                "ngs_te_mapper_run": {"threads": None, "mem_mb": 4000},
+                "ngs_te_mapper_post": {"threads": 1, "mem_mb": 1000}
+        },
+        "ngs_te_mapper2": {
+                "ngs_te_mapper2_pre": {"threads": None, "mem_mb": 2000},
+                "ngs_te_mapper2_run": {"threads": None, "mem_mb": 4000},
+                "ngs_te_mapper2_post": {"threads": 1, "mem_mb": 1000}
+        },
+        "relocate": {
+                "relocaTE_consensus": {"threads": 1, "mem_mb": 1000},
+                "relocaTE_ref_gff": {"threads": 1, "mem_mb": 1000},
+                "relocaTE_run": {"threads": 1, "mem_mb": 4000},
+                "relocaTE_post": {"threads": 1, "mem_mb": 1000}
+        },
+        "relocate2": {
+                "relocaTE2_run": {"threads": None, "mem_mb": 8000},
+                "relocaTE2_post": {"threads": 1, "mem_mb": 1000}
+        },
+        "temp": {
+                "run_temp": {"threads": None, "mem_mb": 4000},
+                "run_temp_shard": {"threads": None, "mem_mb": 4000},
+                "gather_temp": {"threads": 1, "mem_mb": 1000},
+                "process_temp": {"threads": 1, "mem_mb": 1000}
+        },
+        "temp2": {
+                "run_temp2": {"threads": None, "mem_mb": 4000},
+                "process_temp2": {"threads": 1, "mem_mb": 1000}
+        },
+        "retroseq": {
+                "retroseq_run": {"threads": 1, "mem_mb": 4000},
+                "retroseq_discover": {"threads": 1, "mem_mb": 4000},
+                "retroseq_call_shard": {"threads": 1, "mem_mb": 4000},
+                "gather_retroseq": {"threads": 1, "mem_mb": 1000},
+                "retroseq_post": {"threads": 1, "mem_mb": 1000}
+        },
+        "popoolationte": {
+                "make_popoolationte_annotations": {"threads": 1, "mem_mb": 1000},
+                "popoolationTE_ref_fasta": {"threads": 1, "mem_mb": 2000},
+                "popoolationTE_preprocessing": {"threads": None, "mem_mb": 8000},
+                "popoolationTE_run": {"threads": 1, "mem_mb": 8000},
+                "popoolationTE_post": {"threads": 1, "mem_mb": 1000}
+        },
+        "popoolationte2": {
+                "popoolationTE2_preprocessing": {"threads": None, "mem_mb": 8000},
+                "popoolationTE2_run": {"threads": 1, "mem_mb": 16000},
+                "popoolationTE2_post": {"threads": 1, "mem_mb": 1000}
+        },
+        "te-locate": {
+                "telocate_taxonomy": {"threads": 1, "mem_mb": 1000},
+                "telocate_sam": {"threads": 1, "mem_mb": 2000},
+                "telocate_ref": {"threads": 1, "mem_mb": 2000},
+                "telocate_run": {"threads": 1, "mem_mb": 8000},
+                "telocate_post": {"threads": 1, "mem_mb": 1000}
+        },
+        "teflon": {
+                "teflon_preprocessing": {"threads": None, "mem_mb": 8000},
+                "teflon_run": {"threads": None, "mem_mb": 8000},
+                "teflon_post": {"threads": 1, "mem_mb": 1000}
+        },
+        "jitterbug": {
+                "jitterbug_run": {"threads": None, "mem_mb": 4000},
+                "jitterbug_post": {"threads": 1, "mem_mb": 1000}
+        },
+        "tepid": {
+                "tepid_run": {"threads": None, "mem_mb": 8000},
+                "tepid_post": {"threads": 1, "mem_mb": 1000}
+        },
+        "tebreak": {
+                "tebreak_run": {"threads": None, "mem_mb": 8000},
+                "tebreak_post": {"threads": 1, "mem_mb": 1000}
+        }
+}
+
+# snakefiles (in snakefiles/) with the rules of each method, only the snakefiles of the methods being run are included
+METHOD_SNAKEFILES = {
+        "coverage": "coverage.snakefile",
+        "ngs_te_mapper": "ngs_te_mapper.snakefile",
+        "ngs_te_mapper2": "ngs_te_mapper2.snakefile",
+        "relocate": "relocate.snakefile",
+        "relocate2": "relocate2.snakefile",
+        "temp": "temp.snakefile",
+        "temp2": "temp2.snakefile",
+        "retroseq": "retroseq.snakefile",
+        "popoolationte": "popoolationte.snakefile",
+        "popoolationte2": "popoolationte2.snakefile",
+        "te-locate": "telocate.snakefile",
+        "teflon": "teflon.snakefile",
+        "jitterbug": "jitterbug.snakefile",
+        "tepid": "tepid.snakefile",
+        "tebreak": "tebreak.snakefile"
+}
+
+# methods whose rules create inputs for another method (e.g. TEMP uses the TE-locate formatted TE annotations)
+METHOD_DEPENDENCIES = {
+        "temp": ["te-locate"],
+        "temp2": ["te-locate"],
+        "popoolationte2": ["popoolationte"]
+}
+
+# methods that can be split into per-chromosome shards with --scatter
+SCATTER_METHODS = ["temp", "retroseq"]
+
+# rules that replace a whole-genome rule when --scatter is used (used to expand --resume re-runs)
+SCATTER_RULES = {
+        "run_temp": ["scatter_bam", "run_temp_shard", "gather_temp"],
+        "retroseq_run": ["retroseq_discover", "retroseq_call_shard", "gather_retroseq"]
+}
+
+# multithreaded rules that run once per shard, their threads are divided between the shards
+SHARD_RULES = ["run_temp_shard"]
+
+# rules that create files in the reference directory shared by all samples (<out>/<ref_name>/)
+REFERENCE_RULES = ["make_reference_fasta", "make_consensus_fasta", "make_te_annotations", "index_reference_genome"]
+
+# rules to re-run (--resume) if the content of an input file changes
+INPUT_RULES = {
+        "reference": ["make_reference_fasta"],
+        "augment": ["make_reference_fasta", "make_te_annotations"],
+        "consensus": ["make_consensus_fasta"],
+        "locations": ["make_te_annotations"],
+        "taxonomy": ["make_te_annotations"],
+        "coverage_fasta": ["make_coverage_fasta"],
+        "fq1": ["setup_reads"],
+        "fq2": ["setup_reads"]
+}
+
+# rules to re-run (--resume) if a run parameter changes
+PARAM_RULES = {
+        "save_comments": ["map_reads"],
+        "markdup": ["map_reads"],
+        "cram": ["map_reads"],
+        "compress_reads": ["setup_reads"],
+        "max_coverage": ["setup_reads"],
+        "insert_size_pairs": ["median_insert_size", "popoolationTE_run"],
+        "vcf": ["ngs_te_mapper_post", "ngs_te_mapper2_post", "relocaTE_post", "relocaTE2_post", "process_temp", "process_temp2", "retroseq_post", "popoolationTE_post", "popoolationTE2_post", "telocate_post", "teflon_post", "jitterbug_post", "tepid_post", "tebreak_post"]
+}
+
 LOG_DIR = "{{logdir}}"
 STATUS_FILES ={
         "coverage" : LOG_DIR+"status/coverage.status",
@@ -93,13 +259,51 @@ INTERMEDIATE_PATHS = {
         'fq2' : SAM_DIR+"intermediate/fastq/"+SAMPLE_NAME+"_2.fq",
         'sam' : SAM_DIR+"intermediate/mapped_reads/"+SAMPLE_NAME+".sam",
         'bam' : SAM_DIR+"intermediate/mapped_reads/"+SAMPLE_NAME+".sorted.bam",
+        'cram' : SAM_DIR+"intermediate/mapped_reads/"+SAMPLE_NAME+".sorted.cram",
         'duplicate_maked_bam' : SAM_DIR+"intermediate/mapped_reads/"+SAMPLE_NAME+".sorted.duplicate_marked.bam",
         'telocate_sam' : SAM_DIR+"intermediate/mapped_reads/"+SAMPLE_NAME+".telocate.sam",
         'flagstat' : SAM_DIR+"intermediate/mapped_reads/"+SAMPLE_NAME+".bam.flagstat",
         'median_insert_size' : SAM_DIR+"intermediate/mapped_reads/median_insert.size",
+        'ref_te_reads_bam' : SAM_DIR+"intermediate/mapped_reads/"+SAMPLE_NAME+".ref_TE_reads.bam",
+        'bam_shards' : SAM_DIR+"intermediate/mapped_reads/shards/",
         'repeatmasker_out' : SAM_DIR+"intermediate/"+REF_NAME+".repeatmasker.out"
     }
 
+# reference preprocessing outputs that can be stored/restored with --cache (intermediate path key, suffix)
+# listed in the order they are produced by the workflow
+REFERENCE_CACHE_FILES = [
+        ("unaugmented_reference", ""),
+        ("reference", ""),
+        ("consensus", ""),
+        ("unaugmented_locations", ""),
+        ("locations", ""),
+        ("unaugmented_taxonomy", ""),
+        ("taxonomy", ""),
+        ("reference", ".fai"),
+        ("reference", ".amb"),
+        ("reference", ".ann"),
+        ("reference", ".pac"),
+        ("reference", ".sa"),
+        ("reference", ".bwt"),
+        ("masked_fasta", ""),
+        ("ref_te_fasta", ""),
+        ("ref_2bit", ""),
+        ("repeatmasker_out", "")
+]
+
+# scripts that create REFERENCE_CACHE_FILES, changes to these invalidate the cache
+REFERENCE_CACHE_SCRIPTS = [
+        "scripts/fix_fasta.py",
+        "scripts/preprocessing/make_reference_fasta.py",
+        "scripts/preprocessing/make_consensus_fasta.py",
+        "scripts/preprocessing/make_te_annotations.py",
+        "scripts/preprocessing/mask_reference_fasta.py",
+        "scripts/preprocessing/make_ref_te_fasta.py",
+        "scripts/preprocessing/index_reference_genome.py",
+        "scripts/preprocessing/reference_2bit.py",
+        "scripts/preprocessing/repeatmask.py"
+]
+
 RESULTS_DIR = "{{results}}"
 
 OUT_DIRS = {
@@ -144,11 +348,14 @@ OUT_PATHS = {
         'tebreak': METHOD_DIR+SAMPLE_NAME+"_tebreak_nonredundant.bed"
 }
 
+# outputs of these methods are read by other rules (or the summary report), so they can only be cleaned up at the end of the run
+NO_EARLY_CLEANUP_METHODS = ["trimgalore", "map_reads", "coverage"]
+
 ESSENTIAL_PATHS = {
         'coverage': [
                 METHOD_DIR+"te_depth.csv",
                 METHOD_DIR+"plots/",
-                METHOD_DIR+"te-depth-files/"
+                METHOD_DIR+"te_depth.npz"
         ],
 
         'ngs_te_mapper': [
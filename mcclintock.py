@@ -7,15 +7,21 @@ import json
 import random
 import gzip
 import hashlib
+import copy
+import time
+import functools
+import heapq
+import re
+import concurrent.futures
 from datetime import datetime
 import traceback
 
 try:
     sys.path.append(os.path.dirname(os.path.abspath(__file__)))
     import scripts.mccutils as mccutils
+    import scripts.cache as cache
     import internal.sysconfig as sysconfig
     import internal.install as config_install
-    from Bio import SeqIO
 except ImportError as e:
     print(e)
     sys.exit("ERROR...unable to load required python modules\ntry reinstalling and/or activating McClintock environment:\n\tconda env create -f install/envs/mcclintock.yml --name mcclintock\n\tconda activate mcclintock\n")
@@ -34,7 +40,12 @@ def main():
     mccutils.mkdir(args.out+"/logs")
     mccutils.mkdir(args.out+"/tmp")
     check_installed_modules(args.methods, sysconfig.NO_INSTALL_METHODS, config_install.MD5, os.path.dirname(os.path.abspath(__file__))+"/install/")
-    check_input_files(args.reference, args.consensus, args.first, fq2=args.second, locations=args.locations, taxonomy=args.taxonomy, coverage_fasta=args.coverage_fasta, augment_fasta=args.augment, annotations_only=args.make_annotations)
+    if args.samples is not None:
+        run_batch(args, full_command, current_directory)
+        mccutils.remove(args.out+"/tmp")
+        return
+
+    check_input_files(args.reference, args.consensus, args.first, fq2=args.second, locations=args.locations, taxonomy=args.taxonomy, coverage_fasta=args.coverage_fasta, augment_fasta=args.augment, annotations_only=args.make_annotations, proc=args.proc)
     ref_name = mccutils.get_base_name(args.reference)
     run_id, out_files = make_run_config(args, args.sample_name, ref_name, full_command, current_directory, debug=args.debug)
     run_workflow(args, args.sample_name, ref_name, run_id, out_files, debug=args.debug, annotations_only=args.make_annotations)
@@ -47,7 +58,7 @@ def parse_args(expected_configs):
     ## required ##
     parser.add_argument("-r", "--reference", type=str, help="A reference genome sequence in fasta format", required=('--install' not in sys.argv))
     parser.add_argument("-c", "--consensus", type=str, help="The consensus sequences of the TEs for the species in fasta format", required='--install' not in sys.argv)
-    parser.add_argument("-1", "--first", type=str, help="The path of the first fastq file from paired end read sequencing or the fastq file from single read sequencing", required=(('--install' not in sys.argv) and ('--make_annotations' not in sys.argv)))
+    parser.add_argument("-1", "--first", type=str, help="The path of the first fastq file from paired end read sequencing or the fastq file from single read sequencing", required=(('--install' not in sys.argv) and ('--make_annotations' not in sys.argv) and ('--samples' not in sys.argv)))
 
     ## optional ##
     parser.add_argument("-2", "--second", type=str, help="The path of the second fastq file from a paired end read sequencing", required=False)
@@ -65,9 +76,20 @@ def parse_args(expected_configs):
     parser.add_argument("--install", action="store_true", help="This option will install the dependencies of McClintock", required=False)
     parser.add_argument("--resume", action="store_true", help="This option will attempt to use existing intermediate files from a previous McClintock run", required=False)
     parser.add_argument("--debug", action="store_true", help="This option will allow snakemake to print progress to stdout", required=False)
-    parser.add_argument("--serial", action="store_true", help="This option runs without attempting to optimize thread usage to run rules concurrently. Each multithread rule will use the max processors designated by -p/--proc", required=False)
+    parser.add_argument("--mem", type=float, help="The amount of memory (in GB) available to McClintock. Rules are scheduled so their combined memory does not exceed this limit [default: total system memory]", required=False)
+    parser.add_argument("--serial", action="store_true", help="This option runs without attempting to optimize thread usage to run rules concurrently. Each multithread rule will use the max processors designated by -p/--proc, and --samples are run one at a time", required=False)
     parser.add_argument("--make_annotations", action="store_true", help="This option will only run the pipeline up to the creation of the repeat annotations", required=False)
     parser.add_argument("--comments", action="store_true", help="If this option is specified then fastq comments (e.g. barcode) will be incorporated to SAM output. Warning: do not use this option if the input fastq files do not have comments", required=False)
+    parser.add_argument("--cache", type=str, help="A directory used to store reference preprocessing outputs (formatted reference and consensus fasta, TE annotations, indexes, RepeatMasker output) and the read alignments made by TEFLoN, PoPoolationTE, PoPoolationTE2 and TEPID so they can be reused by other runs with the same inputs", required=False)
+    parser.add_argument("--cache_max_size", type=float, help="The maximum size (in GB) of --cache. Least recently used cache entries are removed when this size is exceeded. Aligner indexes are linked into the run directories and are never removed [default: unlimited]", required=False)
+    parser.add_argument("--early_cleanup", action="store_true", help="Remove the non-essential intermediate files of each method as soon as it finishes, instead of after all methods have finished. Reduces the peak disk usage of the run. Follows the -k/--keep_intermediate settings", required=False)
+    parser.add_argument("--scatter", type=int, help="The number of shards to split the reference chromosomes into for methods that can be run per region (temp, retroseq). Each shard runs as a separate job and the results are merged before post processing [default: 1 (no scatter)]", required=False)
+    parser.add_argument("--cram", action="store_true", help="Store the mapped reads as CRAM (compressed against the reference genome) instead of BAM. Methods that require BAM use a temporary copy that is removed once they have finished", required=False)
+    parser.add_argument("--markdup", type=str, help="The tool used to mark duplicate reads in the BAM alignment file. picard runs Picard MarkDuplicates on the sorted BAM, samtools marks duplicates using multiple threads while the reads are sorted, none skips duplicate marking [default: picard][options: picard, samtools, none]", required=False)
+    parser.add_argument("--insert_size_pairs", type=int, help="The number of proper pairs sampled from the start of the BAM to estimate the insert size metrics (median, MAD, percentiles) used by the TE detection methods [default: all pairs]", required=False)
+    parser.add_argument("--max_coverage", type=float, help="Downsample the reads so their estimated coverage of the reference genome is at most this value. Read pairs are selected by a hash of the read name, so the same reads are kept on every run [default: no downsampling]", required=False)
+    parser.add_argument("--compress_reads", action="store_true", help="Keep the intermediate copies of the reads compressed (BGZF). Methods that can't read compressed reads decompress their own temporary copy. Reduces the disk usage of each sample", required=False)
+    parser.add_argument("--samples", type=str, help="A tab-delimited sample sheet with one sample per line and the columns: sample name, fastq 1, fastq 2 (optional). All samples are run against the same reference and the reference files are only prepared once. Samples are then run at the same time, sharing -p/--proc and --mem equally (one at a time with --serial). Replaces -1/--first, -2/--second, and -n/--sample_name", required=False)
     
     #arguments parser
     args = parser.parse_args()
@@ -88,9 +110,23 @@ def parse_args(expected_configs):
     if args.debug is None:
         args.debug = False
 
+    ## check --samples ##
+    if args.samples is not None:
+        if args.first is not None or args.second is not None or args.sample_name is not None:
+            sys.exit("ERROR: -1/--first, -2/--second, and -n/--sample_name can not be used with --samples...exiting...\n")
+        if args.make_annotations:
+            sys.exit("ERROR: --make_annotations can not be used with --samples...exiting...\n")
+        args.samples = read_sample_sheet(mccutils.get_abs_path(args.samples))
+
     ## check -m ##
     ## If only one fastq has been supplied assume this is single ended data and launch only ngs_te_mapper and RelocaTE ##
-    if args.second is None and not args.install:
+    if args.samples is not None:
+        single_end_samples = [sample for sample in args.samples if sample[2] is None]
+        if len(single_end_samples) > 0:
+            valid_methods = sysconfig.SINGLE_END_METHODS
+        else:
+            valid_methods = sysconfig.ALL_METHODS
+    elif args.second is None and not args.install:
         valid_methods = sysconfig.SINGLE_END_METHODS #from config.py
     else:
         valid_methods = sysconfig.ALL_METHODS #from config.py
@@ -130,7 +166,7 @@ def parse_args(expected_configs):
     ## check -c ##
     args.consensus = mccutils.get_abs_path(args.consensus)
 
-    if args.make_annotations != True:
+    if args.make_annotations != True and args.samples is None:
         ## check -1 ## 
         args.first = mccutils.get_abs_path(args.first)
         ## check -2 ## 
@@ -140,6 +176,26 @@ def parse_args(expected_configs):
     ## check -p ## 
     if args.proc is None:
         args.proc = 1
+
+    ## check --scatter ##
+    if args.scatter is None:
+        args.scatter = 1
+    elif args.scatter < 1:
+        sys.exit("ERROR: --scatter must be 1 or greater\n")
+
+    ## check --insert_size_pairs ##
+    if args.insert_size_pairs is not None and args.insert_size_pairs < 1:
+        sys.exit("ERROR: --insert_size_pairs must be 1 or greater\n")
+
+    ## check --max_coverage ##
+    if args.max_coverage is not None and args.max_coverage <= 0:
+        sys.exit("ERROR: --max_coverage must be greater than 0\n")
+
+    ## check --mem ##
+    if args.mem is None:
+        args.mem = get_system_memory()
+    elif args.mem <= 0:
+        sys.exit("ERROR: --mem must be greater than 0\n")
     ## if there is no output argument specified the output will be set to nothing elsewise an output dir is created ## 
     
     ## check -o ## 
@@ -180,8 +236,21 @@ def parse_args(expected_configs):
     if args.augment is not None:
         args.augment = mccutils.get_abs_path(args.augment)
 
+    ## check --cache ##
+    if args.cache is not None:
+        args.cache = os.path.abspath(args.cache)
+        if not os.path.exists(args.cache):
+            os.makedirs(args.cache, exist_ok=True)
+        if args.cache_max_size is not None and args.cache_max_size <= 0:
+            sys.exit("ERROR: --cache_max_size must be greater than 0\n")
+    elif args.cache_max_size is not None:
+        sys.exit("ERROR: --cache_max_size can only be used with --cache\n")
+    args.reference_cache_key = None
+
     ## check sample name ## 
-    if args.sample_name is not None:
+    if args.samples is not None:
+        pass
+    elif args.sample_name is not None:
         if "/" in args.sample_name or args.sample_name == "tmp":
             sys.exit(args.sample_name+" is not a valid sample name...\n")
     else:
@@ -219,13 +288,51 @@ def parse_args(expected_configs):
                 sys.stderr.write("vcf option: "+option+" is not valid. Valid options: "+" ".join(vcf_options)+"\nExample:(--vcf siteonly,sample)\n")
                 sys.exit(1)
 
+    ## check --markdup ##
+    markdup_options = ["picard", "samtools", "none"]
+    if args.markdup is None:
+        args.markdup = "picard"
+    elif args.markdup not in markdup_options:
+        sys.stderr.write("markdup option: "+args.markdup+" is not valid. Valid options: "+" ".join(markdup_options)+"\n")
+        sys.exit(1)
+
     return args
 
-def check_input_files(ref, consensus, fq1, fq2=None, locations=None, taxonomy=None, coverage_fasta=None, augment_fasta=None, annotations_only=False):
-    
-    #calling methods defined shortly to format and check given files
-    ## check reference fasta ## 
-    format_fasta(ref)
+def read_sample_sheet(sample_sheet):
+    samples = []
+    sample_names = set()
+    with open(sample_sheet, "r") as sheet:
+        for line in sheet:
+            line = line.replace("\n","")
+            if line.strip() == "" or line[0] == "#":
+                continue
+
+            split_line = line.split("\t")
+            if len(split_line) < 2 or len(split_line) > 3:
+                sys.exit(sample_sheet+" is not a valid sample sheet. Each line should have the tab-separated columns: sample name, fastq 1, fastq 2 (optional)\n")
+
+            sample_name = split_line[0]
+            if "/" in sample_name or sample_name == "tmp" or sample_name == "":
+                sys.exit(sample_name+" is not a valid sample name in: "+sample_sheet+"\n")
+
+            if sample_name in sample_names:
+                sys.exit("Sample name: "+sample_name+" is not unique in: "+sample_sheet+"\n")
+            sample_names.add(sample_name)
+
+            fq1 = mccutils.get_abs_path(split_line[1])
+            fq2 = None
+            if len(split_line) == 3 and split_line[2] != "":
+                fq2 = mccutils.get_abs_path(split_line[2])
+
+            samples.append((sample_name, fq1, fq2))
+
+    if len(samples) < 1:
+        sys.exit(sample_sheet+" contains no samples... exiting...\n")
+
+    return samples
+
+def check_input_files(ref, consensus, fq1, fq2=None, locations=None, taxonomy=None, coverage_fasta=None, augment_fasta=None, annotations_only=False, proc=1):
+    start = time.time()
 
     if not annotations_only:
         ## check fq1 ## 
@@ -235,35 +342,62 @@ def check_input_files(ref, consensus, fq1, fq2=None, locations=None, taxonomy=No
         if fq2 is not None:
             check_fastq(fq2)
 
-    ## checking consensus ## 
-    consensus_seq_names = format_fasta(consensus)
-
-    ## check locations gff ## 
-    gff_ids = []
+    ## check reference, consensus, locations gff, coverage fasta, and augment fasta ##
+    # these files don't depend on each other so they are checked concurrently
+    checks = [(format_fasta, ref), (format_fasta, consensus)]
     if locations is not None:
-        gff_ids = format_gff(locations)
+        checks.append((format_gff, locations))
+
+    if coverage_fasta is not None:
+        checks.append((format_fasta, coverage_fasta))
+
+    if augment_fasta is not None:
+        checks.append((format_fasta, augment_fasta))
+
+    workers = max(1, min(int(proc), len(checks)))
+    if workers > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(run_input_check, check, in_file) for check, in_file in checks]
+            results = [future.result() for future in futures]
+    else:
+        results = [run_input_check(check, in_file) for check, in_file in checks]
+
+    consensus_seq_names = results[1]
 
     ## check taxonomy ## 
+    gff_ids = set()
+    if locations is not None:
+        gff_ids = results[2]
+
     if taxonomy is not None:
-        format_taxonomy(taxonomy, gff_ids, consensus_seq_names, consensus, locations)
+        run_input_check(format_taxonomy, taxonomy, gff_ids, consensus_seq_names, consensus, locations)
 
-    ## check coverage fasta ## 
-    if coverage_fasta is not None:
-        format_fasta(coverage_fasta)
+    mccutils.log("setup","input files checked in "+str(round(time.time()-start, 2))+" seconds")
 
-    ## check augment fasta ## 
-    if augment_fasta is not None:
-        format_fasta(augment_fasta)
+def run_input_check(check, in_file, *args):
+    start = time.time()
+    result = check(in_file, *args)
+    mccutils.log("setup","checked "+in_file+" in "+str(round(time.time()-start, 2))+" seconds")
+
+    return result
 
 def format_fasta(in_fasta):
     mccutils.log("setup","checking fasta: "+in_fasta)
-    seq_names = []
+    seq_names = set()
     try:
         
-        #iterates through the in_fasta file reorganizing it to allow for repeatmasker to interpret the file.
+        #only the headers are read, sequences are skipped
         with open(in_fasta,"r") as infa:
-            for record in SeqIO.parse(infa, "fasta"):
-                seq_name = str(record.id)
+            for line in infa:
+                if line[0] != ">":
+                    continue
+
+                #sequence name is the first word of the header (same as SeqIO record.id)
+                split_header = line[1:].split(None, 1)
+                seq_name = ""
+                if len(split_header) > 0:
+                    seq_name = split_header[0]
+
                 if "#" in seq_name:
                     org_seq_name = seq_name
                     seq_name = seq_name[:(seq_name.find("#"))]
@@ -278,7 +412,7 @@ def format_fasta(in_fasta):
                     sys.exit(1)
 
                 if masked_seq_name not in seq_names:
-                    seq_names.append(masked_seq_name)
+                    seq_names.add(masked_seq_name)
                 else:
                     sys.exit(in_fasta+": Duplicate sequence name:"+masked_seq_name+"...exiting...\n")
 
@@ -311,7 +445,7 @@ def check_fastq(fastq):
 
 def format_gff(ingff):
     mccutils.log("setup","checking locations gff: "+ingff)
-    gff_ids = []
+    gff_ids = set()
     with open(ingff,"r") as gff:
         
         #creates an array containing any values with a tab between them
@@ -345,10 +479,10 @@ def format_gff(ingff):
                             
                             #adds the masked_gff_id to gff_ids if it is not already there
                             if masked_gff_id not in gff_ids:
-                                gff_ids.append(masked_gff_id)
+                                gff_ids.add(masked_gff_id)
                             else:
                                 sys.exit("ID: "+masked_gff_id+" is not unique. please ensure each feature has a unique ID\n")
-                    if masked_gff_id == "":
+                    if gff_id == "":
                         sys.exit("GFF line: "+line+" is missing an ID attribute (ex. ID=chr1_TY1s1)\n")
 
     return gff_ids
@@ -541,6 +675,23 @@ def setup_config_info(config_dir, method_to_config, config_rules):
 
     return out_dict
 
+def get_included_methods(methods):
+    included_methods = []
+    for method in methods:
+        for included_method in [method] + sysconfig.METHOD_DEPENDENCIES.get(method, []):
+            if included_method not in included_methods:
+                included_methods.append(included_method)
+
+    return included_methods
+
+def trim_to_methods(method_dict, methods):
+    trimmed = {}
+    for key in method_dict.keys():
+        if key in methods:
+            trimmed[key] = method_dict[key]
+
+    return trimmed
+
 def make_run_config(args, sample_name, ref_name, full_command, current_directory, debug=False):
     
     #generates run_id as a random number
@@ -585,21 +736,32 @@ def make_run_config(args, sample_name, ref_name, full_command, current_directory
     mccutils.log("SETUP","McClintock Version: "+git_commit)
         
     #iterate through methods in order to replace a designated directory with a new directory defined at the beginng of this method
-    method_paths = sysconfig.OUT_DIRS
+    method_paths = copy.deepcopy(sysconfig.OUT_DIRS)
     for method in method_paths.keys():
         method_paths[method] = method_paths[method].replace(sysconfig.RESULTS_DIR, results_dir)
         method_paths[method] = method_paths[method].replace(sysconfig.SAM_DIR, sample_dir)
 
     #iterate through the keys in order to replace a designated directory with a new directory defined at the beginng of this method
     out_files_to_make = []
-    out_files = sysconfig.OUT_PATHS
+    out_files = copy.deepcopy(sysconfig.OUT_PATHS)
     for key in out_files.keys():
         out_files[key] = out_files[key].replace(sysconfig.METHOD_DIR, method_paths[key])
         out_files[key] = out_files[key].replace(sysconfig.SAMPLE_NAME, sample_name)
 
+    # the trimmed reads are the compressed intermediate fastq
+    if args.compress_reads:
+        out_files['trimgalore'] += ".gz"
+
     for method in args.methods:
         out_files_to_make.append(out_files[method])
 
+    #methods whose rules are loaded into the workflow
+    included_methods = get_included_methods(args.methods)
+    snakefiles = []
+    for method in included_methods:
+        if method in sysconfig.METHOD_SNAKEFILES:
+            snakefiles.append(mcc_path+"/snakefiles/"+sysconfig.METHOD_SNAKEFILES[method])
+
     #create a new directory as status in another defined directory named after the current date
     now = datetime.now()
     now_str = now.strftime("%Y%m%d.%H%M%S")
@@ -607,16 +769,33 @@ def make_run_config(args, sample_name, ref_name, full_command, current_directory
     mccutils.mkdir(log_dir)
     mccutils.mkdir(log_dir+"/status/")
 
-    status_files = sysconfig.STATUS_FILES
+    status_files = copy.deepcopy(sysconfig.STATUS_FILES)
     for key in status_files.keys():
         status_files[key] = status_files[key].replace(sysconfig.LOG_DIR, log_dir)
 
-    #establish a collection of chromosomes
-    chromosomes = []
-    for record in SeqIO.parse(args.reference, "fasta"):
-        chrom = str(record.id)
-        chrom = mccutils.replace_special_chars(chrom)
-        chromosomes.append(chrom)
+    #write the chromosome names and lengths to a manifest that rules read by path
+    mccutils.mkdir(args.out+"/snakemake/chromosomes")
+    chromosome_manifest = args.out+"/snakemake/chromosomes/chromosomes_"+str(run_id)+".tsv"
+    with open(chromosome_manifest, "w") as manifest:
+        for chrom, length in get_chromosome_lengths(args.reference):
+            manifest.write(chrom+"\t"+str(length)+"\n")
+
+    #split the chromosomes into shards for methods that can run per region
+    scatter_methods = []
+    shard_ids = []
+    shard_dir = args.out+"/snakemake/chromosomes/shards_"+str(run_id)+"/"
+    if args.scatter > 1:
+        for method in args.methods:
+            if method in sysconfig.SCATTER_METHODS:
+                scatter_methods.append(method)
+
+    if len(scatter_methods) > 0:
+        mccutils.mkdir(shard_dir)
+        for x, shard in enumerate(make_shards(get_chromosome_lengths(args.reference), args.scatter)):
+            with open(shard_dir+str(x)+".tsv", "w") as manifest:
+                for chrom, length in shard:
+                    manifest.write(chrom+"\t"+str(length)+"\n")
+            shard_ids.append(str(x))
 
     #establish the data dictonary for useful variables
     data = {}
@@ -634,16 +813,34 @@ def make_run_config(args, sample_name, ref_name, full_command, current_directory
         'methods' : ",".join(args.methods),
         'out_files': ",".join(out_files_to_make),
         'save_comments' : str(args.comments),
-        'max_threads_per_rule' : max(1, calculate_max_threads(args.proc, args.methods, sysconfig.MULTI_THREAD_METHODS, slow=args.serial)),
         'full_command' : full_command,
         'call_directory': current_directory,
         'time': now.strftime("%Y-%m-%d %H:%M:%S"),
-        "chromosomes" : ",".join(chromosomes),
+        "chromosomes" : chromosome_manifest,
         "debug": str(debug),
-        "vcf": ",".join(args.vcf)
+        "vcf": ",".join(args.vcf),
+        "scatter": str(args.scatter),
+        "compress_reads": str(args.compress_reads),
+        "insert_size_pairs": str(args.insert_size_pairs),
+        "markdup": args.markdup,
+        "cram": str(args.cram),
+        "max_coverage": str(args.max_coverage)
+    }
+
+    data['scatter'] = {
+        'methods': scatter_methods,
+        'shards': shard_ids,
+        'shard_dir': shard_dir
     }
 
-    data["config"] = setup_config_info(args.config, sysconfig.CONFIGS, sysconfig.CONFIG_RULES)
+    ##threads and memory for each rule##
+    avail_mem = None
+    if args.mem is not None:
+        avail_mem = int(args.mem * 1024)
+    data['resources'] = calculate_rule_resources(args.proc, avail_mem, args.methods, trim_to_methods(sysconfig.RULE_RESOURCES, ["processing"]+included_methods), slow=args.serial, shards=max(1, len(shard_ids)))
+
+    # trimgalore config is always used by setup_reads
+    data["config"] = setup_config_info(args.config, trim_to_methods(sysconfig.CONFIGS, ["trimgalore"]+included_methods), sysconfig.CONFIG_RULES)
 
     ##input paths for files##
     data["in"] = {
@@ -657,7 +854,7 @@ def make_run_config(args, sample_name, ref_name, full_command, current_directory
     }
 
     ##where mcc copies will be stored## 
-    data["mcc"] = sysconfig.INTERMEDIATE_PATHS
+    data["mcc"] = copy.deepcopy(sysconfig.INTERMEDIATE_PATHS)
     for key in data["mcc"].keys():
         data["mcc"][key] = data["mcc"][key].replace(sysconfig.INPUT_DIR, input_dir)
         data["mcc"][key] = data["mcc"][key].replace(sysconfig.REF_DIR, reference_dir)
@@ -665,13 +862,19 @@ def make_run_config(args, sample_name, ref_name, full_command, current_directory
         data["mcc"][key] = data["mcc"][key].replace(sysconfig.REF_NAME, ref_name)
         data["mcc"][key] = data["mcc"][key].replace(sysconfig.SAMPLE_NAME, sample_name)
 
-    data['status'] = status_files
+    if args.compress_reads:
+        for key in ["fq1", "fq2"]:
+            data["mcc"][key] += ".gz"
+
+    data['status'] = trim_to_methods(status_files, included_methods)
 
-    data["out"] = out_files
+    data["out"] = trim_to_methods(out_files, included_methods)
 
-    data['outdir'] = method_paths
+    data['outdir'] = trim_to_methods(method_paths, included_methods)
 
-    data["essential"] = sysconfig.ESSENTIAL_PATHS
+    data['snakefiles'] = snakefiles
+
+    data["essential"] = trim_to_methods(copy.deepcopy(sysconfig.ESSENTIAL_PATHS), included_methods)
     
     #asssign the essential keys a storage site
     for key in data["essential"].keys():
@@ -681,17 +884,259 @@ def make_run_config(args, sample_name, ref_name, full_command, current_directory
             data["essential"][key][x] = data["essential"][key][x].replace(sysconfig.REF_NAME, ref_name)
 
     env_path = os.path.dirname(os.path.abspath(__file__))+"/install/envs/"
-    data["envs"] = config_install.ENV
+    data["envs"] = copy.deepcopy(config_install.ENV)
     for key in data["envs"].keys():
         data['envs'][key] = data['envs'][key].replace(config_install.ENV_PATH, env_path)
 
+    if args.cache is not None and args.reference_cache_key is None:
+        mccutils.log("setup", "calculating reference cache key")
+        args.reference_cache_key = get_reference_cache_key(args, mcc_path, data['envs']['processing'])
+    data['args']['cache'] = str(args.cache)
+    data['args']['cache_max_size'] = str(args.cache_max_size)
+
+    ##per-method cleanup targets used by --early_cleanup##
+    data['cleanup'] = {}
+    if args.early_cleanup:
+        for method in get_early_cleanup_methods(args.keep_intermediate, args.methods):
+            data['cleanup'][method] = log_dir+"cleanup/"+method+".done"
+
+    ##content digests used by --resume to find rules that need to be re-run##
+    data['digests'] = {
+        'inputs': get_input_digests(args),
+        'params': {
+            'save_comments': str(args.comments),
+            'vcf': ",".join(args.vcf),
+            'compress_reads': str(args.compress_reads),
+            'insert_size_pairs': str(args.insert_size_pairs),
+            'markdup': args.markdup,
+            'cram': str(args.cram),
+            'max_coverage': str(args.max_coverage)
+        },
+        'rules': get_rule_digests(mcc_path, data['envs'], snakefiles)
+    }
+    data['args']['reference_cache_key'] = str(args.reference_cache_key)
+
     #creates a json config file based on the run_cofig file
     with open(run_config,"w") as conf:
         json.dump(data, conf, indent=4)
 
     return run_id, out_files
 
-def run_workflow(args, sample_name, ref_name, run_id, out_files, debug=False, annotations_only=False):
+@functools.lru_cache(maxsize=None)
+def get_chromosome_lengths(reference):
+    chromosomes = []
+    fai = reference+".fai"
+    if os.path.exists(fai) and os.path.getmtime(fai) >= os.path.getmtime(reference):
+        with open(fai, "r") as inf:
+            for line in inf:
+                split_line = line.split("\t")
+                chromosomes.append((mccutils.replace_special_chars(split_line[0]), int(split_line[1])))
+
+    else:
+        #header and length scan, sequences are never stored
+        with open(reference, "r") as inf:
+            chrom = None
+            length = 0
+            for line in inf:
+                if line[0] == ">":
+                    if chrom is not None:
+                        chromosomes.append((chrom, length))
+                    split_header = line[1:].split(None, 1)
+                    chrom = ""
+                    if len(split_header) > 0:
+                        chrom = split_header[0]
+                    chrom = mccutils.replace_special_chars(chrom)
+                    length = 0
+                elif chrom is not None:
+                    length += len(line.strip())
+
+            if chrom is not None:
+                chromosomes.append((chrom, length))
+
+    return tuple(chromosomes)
+
+@functools.lru_cache(maxsize=None)
+def get_file_digest(in_file):
+    return cache.sampled_md5(in_file)
+
+def get_input_digests(args):
+    in_files = {
+        'reference': args.reference,
+        'augment': args.augment,
+        'consensus': args.consensus,
+        'locations': args.locations,
+        'taxonomy': args.taxonomy,
+        'coverage_fasta': args.coverage_fasta,
+        'fq1': args.first,
+        'fq2': args.second
+    }
+
+    digests = {}
+    for key in in_files.keys():
+        if in_files[key] is None:
+            digests[key] = "None"
+        else:
+            digests[key] = get_file_digest(in_files[key])
+
+    return digests
+
+@functools.lru_cache(maxsize=None)
+def get_script_imports(mcc_path, script):
+    # the mcclintock modules (scripts.*, internal.*) a script imports, and the modules they import in turn
+    # modules in scripts/ import each other by their plain name (import mccutils)
+    imports = set()
+    with open(mcc_path+script, "r") as inf:
+        for line in inf:
+            for module in re.findall(r"^\s*(?:import|from)\s+((?:scripts|internal)\.[\w.]+)", line):
+                imports.add("/"+module.replace(".", "/")+".py")
+            if script.count("/") == 2:
+                for module in re.findall(r"^\s*import\s+(\w+)", line):
+                    if os.path.exists(mcc_path+"/scripts/"+module+".py"):
+                        imports.add("/scripts/"+module+".py")
+
+    for module in list(imports):
+        if module != script and os.path.exists(mcc_path+module):
+            imports.update(get_script_imports(mcc_path, module))
+
+    imports.discard(script)
+    return frozenset(imports)
+
+def get_rule_digests(mcc_path, envs, method_snakefiles):
+    snakefiles = [mcc_path+"/Snakefile"] + method_snakefiles
+
+    # rule definitions without blank lines and comments
+    # rules can be indented (e.g. defined inside an if block), their body is indented further than the header
+    rule_lines = {}
+    for snakefile in snakefiles:
+        rule = None
+        rule_indent = 0
+        with open(snakefile, "r") as inf:
+            for line in inf:
+                header = re.match(r"^(\s*)rule\s+(\w+)\s*:\s*$", line)
+                indent = len(line) - len(line.lstrip())
+                if header is not None:
+                    rule = header.group(2)
+                    rule_indent = len(header.group(1))
+                    rule_lines[rule] = []
+                elif line.strip() == "" or line.strip()[0] == "#":
+                    continue
+                elif indent <= rule_indent:
+                    rule = None
+                elif rule is not None:
+                    rule_lines[rule].append(line.strip())
+
+    # each rule digest covers the rule definition, the script it runs, the modules the script imports,
+    # and its conda env
+    digests = {}
+    for rule in rule_lines.keys():
+        md5 = hashlib.md5("\n".join(rule_lines[rule]).encode())
+        modules = set()
+        for line in rule_lines[rule]:
+            for script in re.findall(r'"(/scripts/[^"]+\.py)"', line):
+                md5.update(cache.file_md5(mcc_path+script).encode())
+                modules.update(get_script_imports(mcc_path, script))
+            for env in re.findall(r"config\['envs'\]\['([^']+)'\]", line):
+                md5.update(cache.file_md5(envs[env]).encode())
+
+        for module in sorted(modules):
+            if os.path.exists(mcc_path+module):
+                md5.update((module+"="+get_file_digest(mcc_path+module)).encode())
+        digests[rule] = md5.hexdigest()
+
+    return digests
+
+def get_reference_cache_key(args, mcc_path, processing_env):
+    in_files = [
+        ("reference", args.reference),
+        ("consensus", args.consensus),
+        ("locations", args.locations),
+        ("taxonomy", args.taxonomy),
+        ("augment", args.augment)
+    ]
+    support_files = [mcc_path+"/"+script for script in sysconfig.REFERENCE_CACHE_SCRIPTS]
+    support_files.append(processing_env)
+
+    return cache.get_key(in_files, support_files)
+
+def get_reference_cache_files(config_json):
+    with open(config_json) as f:
+        config = json.load(f)
+
+    cache_files = []
+    for key, suffix in sysconfig.REFERENCE_CACHE_FILES:
+        cache_files.append((key+suffix, config['mcc'][key]+suffix))
+
+    return cache_files
+
+def run_batch(args, full_command, current_directory):
+    ref_name = mccutils.get_base_name(args.reference)
+    check_input_files(args.reference, args.consensus, None, locations=args.locations, taxonomy=args.taxonomy, coverage_fasta=args.coverage_fasta, augment_fasta=args.augment, annotations_only=True, proc=args.proc)
+    for sample_name, fq1, fq2 in args.samples:
+        check_fastq(fq1)
+        if fq2 is not None:
+            check_fastq(fq2)
+
+    ## reference files are prepared once and shared by every sample in the sheet ##
+    mccutils.log("setup", "preparing reference files shared by "+str(len(args.samples))+" samples")
+    reference_args = copy.copy(args)
+    reference_args.first = None
+    reference_args.second = None
+    run_id, out_files = make_run_config(reference_args, "tmp", ref_name, full_command, current_directory, debug=args.debug)
+    args.reference_cache_key = reference_args.reference_cache_key
+    run_workflow(reference_args, "tmp", ref_name, run_id, out_files, debug=args.debug, reference_only=True)
+
+    ## samples run at the same time, each with an equal share of -p/--proc and --mem ##
+    concurrent_samples = get_concurrent_samples(args, len(args.samples))
+    mccutils.log("setup", "running "+str(len(args.samples))+" samples, "+str(concurrent_samples)+" at a time")
+    sample_runs = []
+    for sample_name, fq1, fq2 in args.samples:
+        sample_args = copy.copy(args)
+        sample_args.first = fq1
+        sample_args.second = fq2
+        sample_args.sample_name = sample_name
+        sample_args.proc = args.proc//concurrent_samples
+        if args.mem is not None:
+            sample_args.mem = args.mem/concurrent_samples
+        run_id, out_files = make_run_config(sample_args, sample_name, ref_name, full_command, current_directory, debug=args.debug)
+        sample_runs.append((sample_args, sample_name, run_id, out_files))
+
+    if concurrent_samples > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=concurrent_samples) as executor:
+            futures = [executor.submit(run_sample, sample_args, sample_name, ref_name, run_id, out_files) for sample_args, sample_name, run_id, out_files in sample_runs]
+            failed = [sample_run[1] for sample_run, future in zip(sample_runs, futures) if not future.result()]
+    else:
+        failed = [sample_run[1] for sample_run in sample_runs if not run_sample(sample_run[0], sample_run[1], ref_name, sample_run[2], sample_run[3])]
+
+    if len(failed) > 0:
+        sys.exit("ERROR: McClintock failed for samples: "+", ".join(failed)+"\n")
+
+def get_concurrent_samples(args, samples):
+    # as many samples as there are processors, limited by the memory needed by the largest rule of the run
+    if args.serial:
+        return 1
+
+    concurrent_samples = min(samples, args.proc)
+    if args.mem is not None:
+        rule_resources = trim_to_methods(sysconfig.RULE_RESOURCES, ["processing"]+get_included_methods(args.methods))
+        max_rule_mem = max([rule['mem_mb'] for group in rule_resources.values() for rule in group.values()])
+        concurrent_samples = min(concurrent_samples, int(args.mem * 1024)//max_rule_mem)
+
+    return max(1, concurrent_samples)
+
+def run_sample(args, sample_name, ref_name, run_id, out_files):
+    # runs in its own process when samples are run at the same time, so a failed sample does not stop the others
+    mccutils.log("setup", "running sample: "+sample_name)
+    try:
+        run_workflow(args, sample_name, ref_name, run_id, out_files, debug=args.debug, shared_reference=True)
+    except SystemExit as e:
+        if e.code not in (None, 0):
+            if not isinstance(e.code, int):
+                print(e.code, file=sys.stderr)
+            return False
+
+    return True
+
+def run_workflow(args, sample_name, ref_name, run_id, out_files, debug=False, annotations_only=False, reference_only=False, shared_reference=False):
     
     #creates the strings representing the complete directories for the locations of prestablished files
     log = args.out+"/mcclintock."+str(run_id)+".log"
@@ -713,10 +1158,12 @@ def run_workflow(args, sample_name, ref_name, run_id, out_files, debug=False, an
     config_json = args.out+"/snakemake/config/config_"+str(run_id)+".json"
     command += ["--configfile", config_json]
     command += ["--cores", str(args.proc)]
+    if args.mem is not None:
+        command += ["--resources", "mem_mb="+str(int(args.mem * 1024))]
 
     #check if there is already the remenants of a previous run that need to be extracted to run
     if not args.resume:
-        if os.path.exists(reference_dir) and len(os.listdir(reference_dir)) > 0:
+        if not shared_reference and os.path.exists(reference_dir) and len(os.listdir(reference_dir)) > 0:
             mccutils.remove(config_json)
             sys.exit("ERROR: output directory:"+reference_dir+" is not empty. If wanting to resume a previous run, use --resume, otherwise please delete this directory or change your -o/--output\n")
         if os.path.exists(sample_dir) and len(os.listdir(sample_dir)) > 0:
@@ -729,20 +1176,37 @@ def run_workflow(args, sample_name, ref_name, run_id, out_files, debug=False, an
         mccutils.log("setup","Checking config files to ensure previous intermediate files are compatible with this run")
         config_found = False
         previous_config_md5s = {}
+        previous_digests = {}
         for prev_config in os.listdir(input_dir+"/snakemake/config/"):
             if prev_config != "config_"+str(run_id)+".json":
                 config_found = True
-                config_compatible = config_compatibility(input_dir+"/snakemake/config/config_"+str(run_id)+".json", args.out+"/snakemake/config/"+prev_config)
+                if has_digests(args.out+"/snakemake/config/"+prev_config):
+                    previous_digests = get_recent_digests(config_json, args.out+"/snakemake/config/"+prev_config, previous_digests)
+                else:
+                    # configs from before digests were recorded can only be checked by path and commit
+                    config_compatible = config_compatibility(config_json, args.out+"/snakemake/config/"+prev_config)
+                    if not config_compatible:
+                        mccutils.remove(config_json)
+                        sys.exit(1)
                 previous_config_md5s = get_recent_config_md5s(args.out+"/snakemake/config/"+prev_config, previous_config_md5s)
-                if not config_compatible:
-                    mccutils.remove(config_json)
-                    sys.exit(1)
 
         if not config_found:
             mccutils.remove(config_json)
             sys.exit("ERROR: Unable to resume run. No config files from previous runs found in:"+input_dir+"/snakemake/config/ Remove --resume for clean run\n")
 
         rules_to_rerun = get_rules_to_rerun(input_dir+"/snakemake/config/config_"+str(run_id)+".json", previous_config_md5s)
+        for rule in get_invalidated_rules(config_json, previous_digests):
+            if rule not in rules_to_rerun:
+                rules_to_rerun.append(rule)
+        if args.scatter > 1:
+            for rule in list(rules_to_rerun):
+                for scatter_rule in sysconfig.SCATTER_RULES.get(rule, []):
+                    if scatter_rule not in rules_to_rerun:
+                        rules_to_rerun.append(scatter_rule)
+        # rules of methods that are not part of this run are not loaded by snakemake
+        with open(config_json) as f:
+            workflow_rules = json.load(f)['digests']['rules']
+        rules_to_rerun = [rule for rule in rules_to_rerun if rule in workflow_rules]
         command.append("-R")
         if len(rules_to_rerun) > 0:
             for rule in rules_to_rerun:
@@ -755,11 +1219,23 @@ def run_workflow(args, sample_name, ref_name, run_id, out_files, debug=False, an
         command.append("--reason")
         command.append("--verbose")
 
-    if not annotations_only:
+    if reference_only:
+        command.append(reference_dir+"reference_te_locations/inrefTEs.gff")
+        command.append(reference_dir+"te_taxonomy/taxonomy.tsv")
+        command.append(reference_dir+"consensus_fasta/consensusTEs.fasta")
+        command.append(reference_dir+"genome_fasta/"+ref_name+".fasta.fai")
+        command.append(reference_dir+"genome_fasta/"+ref_name+".fasta.bwt")
+    elif not annotations_only:
         for method in args.methods:
             command.append(out_files[method])
 
         command.append(sample_dir+"results/summary/data/run/summary_report.txt")
+
+        with open(config_json) as f:
+            cleanup_targets = json.load(f)['cleanup']
+        for method in args.methods:
+            if method in cleanup_targets:
+                command.append(cleanup_targets[method])
     else:
         command.append(reference_dir+"reference_te_locations/inrefTEs.gff")
         command.append(reference_dir+"te_taxonomy/taxonomy.tsv")
@@ -769,6 +1245,8 @@ def run_workflow(args, sample_name, ref_name, run_id, out_files, debug=False, an
         sys.stdout.flush()
         mccutils.mkdir(sample_dir)
         mccutils.mkdir(sample_dir+"tmp")
+        if args.cache is not None:
+            cache.restore(args.cache, "reference", args.reference_cache_key, get_reference_cache_files(config_json))
         if debug:
             print(" ".join(command))
         mccutils.run_command(command)
@@ -778,7 +1256,15 @@ def run_workflow(args, sample_name, ref_name, run_id, out_files, debug=False, an
         print("McClintock Pipeline Failed... please open an issue at https://github.com/bergmanlab/mcclintock/issues if you are having trouble using McClintock", file=sys.stderr)
         sys.exit(1)
     mccutils.remove(sample_dir+"tmp")
-    remove_intermediate_files(args.keep_intermediate, config_json, args.methods, ref_name, sample_name, args.out)
+    if args.cache is not None:
+        max_size = None
+        if args.cache_max_size is not None:
+            max_size = int(args.cache_max_size * 1024**3)
+        cache.store(args.cache, "reference", args.reference_cache_key, get_reference_cache_files(config_json), max_size=max_size)
+
+    if reference_only:
+        return
+    remove_intermediate_files(args.keep_intermediate, config_json, args.methods, ref_name, sample_name, args.out, threads=args.proc)
 
 def get_recent_config_md5s(prev_config, config_md5s):
     
@@ -814,6 +1300,77 @@ def get_rules_to_rerun(run_config, prev_md5s):
 
     return rules_to_rerun
 
+def has_digests(config_file):
+    with open(config_file) as f:
+        config_data = json.load(f)
+
+    return 'digests' in config_data.keys()
+
+def get_recent_digests(run_config, prev_config, digests):
+    with open(run_config) as f:
+        run_config_data = json.load(f)
+
+    with open(prev_config) as f:
+        prev_config_data = json.load(f)
+
+    start_time = datetime.strptime(prev_config_data['args']['time'], '%Y-%m-%d %H:%M:%S')
+    prev_methods = prev_config_data['args']['methods'].split(",")
+
+    # files in the sample directory can only be compared to previous runs of the same sample
+    same_sample = (run_config_data['args']['sample_name'] == prev_config_data['args']['sample_name'] and "--make_annotations" not in prev_config_data['args']['full_command'])
+
+    rule_groups = {}
+    for group in sysconfig.RULE_RESOURCES.keys():
+        for rule in sysconfig.RULE_RESOURCES[group].keys():
+            rule_groups[rule] = group
+
+    prev_digests = []
+    for key, digest in prev_config_data['digests']['inputs'].items():
+        if same_sample or key not in ["fq1", "fq2", "coverage_fasta"]:
+            prev_digests.append((("inputs", key), digest))
+
+    if same_sample:
+        for key, digest in prev_config_data['digests']['params'].items():
+            prev_digests.append((("params", key), digest))
+
+    for rule, digest in prev_config_data['digests']['rules'].items():
+        if not same_sample and rule not in sysconfig.REFERENCE_RULES:
+            continue
+
+        group = rule_groups.get(rule, "processing")
+        if group == "processing" or group in prev_methods:
+            prev_digests.append((("rules", rule), digest))
+
+    for key, digest in prev_digests:
+        if key not in digests.keys() or digests[key][1] < start_time:
+            digests[key] = [digest, start_time]
+
+    return digests
+
+def get_invalidated_rules(run_config, prev_digests):
+    with open(run_config) as f:
+        run_config_data = json.load(f)
+
+    invalidated_rules = []
+    for category, key in prev_digests.keys():
+        digest = run_config_data['digests'][category].get(key)
+        if digest is None or digest == prev_digests[(category, key)][0]:
+            continue
+
+        if category == "inputs":
+            rules = sysconfig.INPUT_RULES[key]
+        elif category == "params":
+            rules = sysconfig.PARAM_RULES[key]
+        else:
+            rules = [key]
+
+        mccutils.log("setup", "(--resume) "+key+" changed since previous run, rerunning: "+" ".join(rules))
+        for rule in rules:
+            if rule not in invalidated_rules:
+                invalidated_rules.append(rule)
+
+    return invalidated_rules
+
 def config_compatibility(run_config, prev_config):
     with open(run_config) as f:
         run_config_data = json.load(f)
@@ -850,7 +1407,7 @@ def config_compatibility(run_config, prev_config):
             return False
 
     ##check fastq compatibility##
-    if "--make_annotations" not in prev_config_data['args']['full_command']:
+    if "--make_annotations" not in prev_config_data['args']['full_command'] and run_config_data['args']['sample_name'] == prev_config_data['args']['sample_name']:
         if os.path.exists(run_config_data["mcc"]["fq1"]):
             if run_config_data["in"]["fq1"] != prev_config_data["in"]["fq1"]:
                 sys.stderr.write("(--resume) ERROR: Unable to resume McClintock run\n")
@@ -903,28 +1460,88 @@ def config_compatibility(run_config, prev_config):
 
     return True
 
-def calculate_max_threads(avail_procs, methods_used, multithread_methods, slow=False):
-    max_threads = avail_procs
+def get_system_memory():
+    try:
+        mem_bytes = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+        return mem_bytes / (1024**3)
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def make_shards(chromosome_lengths, num_shards):
+    # largest chromosomes first, each into the shard with the fewest bases so far
+    shards = [[] for x in range(min(num_shards, len(chromosome_lengths)))]
+    shard_sizes = [(0, x) for x in range(len(shards))]
+    order = {}
+    for x, (chrom, length) in enumerate(chromosome_lengths):
+        order[chrom] = x
+
+    for chrom, length in sorted(chromosome_lengths, key=lambda c: c[1], reverse=True):
+        size, x = heapq.heappop(shard_sizes)
+        shards[x].append((chrom, length))
+        heapq.heappush(shard_sizes, (size+length, x))
+
+    # keep the reference order within each shard
+    for shard in shards:
+        shard.sort(key=lambda c: order[c[0]])
+
+    return shards
+
+def calculate_rule_resources(avail_procs, avail_mem, methods_used, rule_resources, slow=False, shards=1):
+    # multithreaded detector rules can run at the same time, so they share the available processors
+    multi_methods_used = []
+    for method in methods_used:
+        if method in rule_resources:
+            for rule in rule_resources[method].keys():
+                if rule_resources[method][rule]['threads'] is None and method not in multi_methods_used:
+                    multi_methods_used.append(method)
+
+    concurrent_methods = max(1, len(multi_methods_used))
+
+    # don't plan to run more multithreaded methods at once than will fit in memory
+    if avail_mem is not None and len(multi_methods_used) > 0:
+        max_method_mem = 0
+        for method in multi_methods_used:
+            for rule in rule_resources[method].keys():
+                max_method_mem = max(max_method_mem, rule_resources[method][rule]['mem_mb'])
+        concurrent_methods = max(1, min(concurrent_methods, avail_mem//max_method_mem))
+
+    resources = {}
+    for group in rule_resources.keys():
+        for rule in rule_resources[group].keys():
+            profile = rule_resources[group][rule]
+            if profile['threads'] is None:
+                # preprocessing rules mostly run before the methods start, so they get all processors
+                if slow or group == "processing":
+                    threads = avail_procs
+                else:
+                    threads = max(1, avail_procs//concurrent_methods)
+
+                # shards of a method run at the same time, so they share the method's processors
+                if rule in sysconfig.SHARD_RULES:
+                    threads = max(1, threads//shards)
+            else:
+                threads = max(1, min(profile['threads'], avail_procs))
 
-    #check and return the amount of threads allocated for the process
-    if not slow:
-        multi_methods_used = 0
-        for method in methods_used:
-            if method in multithread_methods:
-                multi_methods_used += 1
+            mem_mb = profile['mem_mb']
+            if avail_mem is not None:
+                mem_mb = min(mem_mb, avail_mem)
 
-        if multi_methods_used > 1:
-            is_even = False
-            if max_threads%2 == 0:
-                is_even = True
+            resources[rule] = {'threads': threads, 'mem_mb': mem_mb}
 
-            max_threads = max_threads//2
-            if is_even:
-                max_threads = max_threads-1
+    return resources
 
-    return max_threads
+def get_early_cleanup_methods(options, methods):
+    if "all" in options or "methods" in options:
+        return []
 
-def remove_intermediate_files(options, run_config_file, methods, ref_name, sample_name, outdir):
+    cleanup_methods = []
+    for method in methods:
+        if method not in options and method not in sysconfig.NO_EARLY_CLEANUP_METHODS:
+            cleanup_methods.append(method)
+
+    return cleanup_methods
+
+def remove_intermediate_files(options, run_config_file, methods, ref_name, sample_name, outdir, threads=1):
     if "all" in options:
         return
 
@@ -936,52 +1553,14 @@ def remove_intermediate_files(options, run_config_file, methods, ref_name, sampl
         for method in methods:
             method_out = "/".join(run_config_data['out'][method].split("/")[:-1])+"/"
             if method not in options:
-                essential_paths = run_config_data['essential'][method]
-                if os.path.exists(method_out):
-                    ##delete all files not marked as essential##
-                    for root, subdirs, files in os.walk(method_out, topdown=False):
-                        for f in files:
-                            file_path = os.path.join(root, f)
-                            is_essential = False
-                            for essential_path in essential_paths:
-                                if (os.path.isdir(essential_path) and essential_path in file_path) or (essential_path == file_path):
-                                    is_essential = True
-
-                            if not is_essential:
-                                mccutils.remove(file_path)
-
-                    ##remove empty directories##
-                    for root, subdirs, files in os.walk(method_out, topdown=False):
-                        for d in subdirs:
-                            dir_path = os.path.join(root, d)
-                            if len(os.listdir(dir_path)) < 1:
-                                mccutils.remove(dir_path)
-
+                ##delete all files not marked as essential##
+                mccutils.remove_nonessential(method_out, run_config_data['essential'][method], threads=threads)
             else:
                 keep_paths.append(method_out)
 
     if "general" not in options:
         intermediate_dir = outdir+"/"+sample_name+"/intermediate/"
-        for root, subdirs, files in os.walk(intermediate_dir, topdown=False):
-            for f in files:
-                file_path = os.path.join(root, f)
-                keep = False
-                for keep_path in keep_paths:
-                    if keep_path in file_path:
-                        keep = True
-
-                if not keep:
-                    mccutils.remove(file_path)
-
-        ##remove empty directories##
-        for root, subdirs, files in os.walk(intermediate_dir, topdown=False):
-            for d in subdirs:
-                dir_path = os.path.join(root, d)
-                if len(os.listdir(dir_path)) < 1:
-                    mccutils.remove(dir_path)
-
-        if len(os.listdir(intermediate_dir)) < 1:
-            mccutils.remove(intermediate_dir)
+        mccutils.remove_nonessential(intermediate_dir, keep_paths, threads=threads, remove_root=True)
 
 if __name__ == "__main__":
     main()
@@ -42,7 +42,7 @@ def main():
             mccutils.remove(out_dir+"/"+f)
 
         mccutils.log("temp","running TEMP Module")
-        median_insert_size = get_median_insert_size(median_insert_size_file)
+        median_insert_size = mccutils.get_median_insert_size(median_insert_size_file)
         run_temp_insertion(bam, scripts_dir, consensus, ref_te_bed, taxonomy, median_insert_size, threads, out_dir, log)
         run_temp_absence(bam, scripts_dir, consensus, ref_te_bed, twobit, taxonomy, median_insert_size, threads, out_dir, log)
         mccutils.check_file_exists(snakemake.output[0])
@@ -66,16 +66,6 @@ def main():
 
 
 
-def get_median_insert_size(infile):
-    median_insert_size = 0
-    with open(infile,"r") as inf:
-        for line in inf:
-            insert = line.split("=")[1]
-            insert = insert.replace("\n","")
-            median_insert_size = int(float(insert))
-    
-    return median_insert_size
-
     
 def run_temp_insertion(bam, scripts, consensus, te_bed, taxonomy, median_insert_size, threads, out, log):
     mccutils.log("temp","running TEMP non-reference insertion prediction", log=log)
@@ -0,0 +1,296 @@
+import os
+import sys
+import time
+import fcntl
+import shutil
+import hashlib
+import subprocess
+import functools
+from contextlib import contextmanager
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import mccutils as mccutils
+
+LAST_USED = ".last_used"
+ALIGNMENT_STORE = "alignments"
+INDEX_STORE = "indexes"
+# suffixes of the files each index type adds to its prefix (the fasta path for bwa and faidx)
+INDEX_FILES = {
+    "bwa": [".amb", ".ann", ".bwt", ".pac", ".sa"],
+    "faidx": [".fai"],
+    "bowtie2": [".1.bt2", ".2.bt2", ".3.bt2", ".4.bt2", ".rev.1.bt2", ".rev.2.bt2"],
+    "yaha": [".nib2", ".X15_01_65525S"],
+    "2bit": [".2bit"]
+}
+
+def file_md5(infile, block_size=1048576):
+    md5 = hashlib.md5()
+    with open(infile, "rb") as inf:
+        for block in iter(lambda: inf.read(block_size), b""):
+            md5.update(block)
+
+    return md5.hexdigest()
+
+def sampled_md5(infile, max_full_size=67108864, block_size=1048576, samples=16):
+    # files larger than max_full_size are digested from their size and evenly spaced blocks
+    size = os.path.getsize(infile)
+    if size <= max_full_size:
+        return file_md5(infile, block_size=block_size)
+
+    md5 = hashlib.md5(str(size).encode())
+    with open(infile, "rb") as inf:
+        for x in range(samples):
+            inf.seek(((size-block_size)*x)//(samples-1))
+            md5.update(inf.read(block_size))
+
+    return "sampled:"+md5.hexdigest()
+
+def get_key(in_files, support_files):
+    # in_files: list of (label, path or None) for the user inputs
+    # support_files: scripts/envs whose changes should invalidate the cache
+    key = hashlib.md5()
+    for label, in_file in in_files:
+        if in_file is None or in_file == "None":
+            key.update((label+"=None\n").encode())
+        else:
+            key.update((label+"="+file_md5(in_file)+"\n").encode())
+
+    for support_file in support_files:
+        key.update((os.path.basename(support_file)+"="+file_md5(support_file)+"\n").encode())
+
+    return key.hexdigest()
+
+@contextmanager
+def file_lock(lock_file, shared=False, blocking=True):
+    mode = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+    if not blocking:
+        mode = mode | fcntl.LOCK_NB
+
+    with open(lock_file, "a") as lock:
+        fcntl.flock(lock, mode)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+def get_entry(cache_dir, store_name, key):
+    store_dir = cache_dir+"/"+store_name+"/"
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir, exist_ok=True)
+
+    return store_dir+key+"/", store_dir+key+".lock"
+
+def restore(cache_dir, store_name, key, files, log=None):
+    # files: list of (name in cache, destination) in the order they are produced by the pipeline
+    entry, lock_file = get_entry(cache_dir, store_name, key)
+    restored = []
+    if not os.path.exists(entry):
+        return restored
+
+    with file_lock(lock_file, shared=True):
+        if not os.path.exists(entry):
+            return restored
+
+        for name, dest in files:
+            if os.path.exists(entry+name) and not os.path.exists(dest):
+                os.makedirs(os.path.dirname(os.path.abspath(dest)), exist_ok=True)
+                mccutils.remove(dest+".tmp")
+                if os.path.islink(entry+name):
+                    os.symlink(os.path.realpath(entry+name), dest+".tmp")
+                else:
+                    shutil.copyfile(entry+name, dest+".tmp")
+                os.replace(dest+".tmp", dest)
+                restored.append(dest)
+
+        touch(entry+LAST_USED)
+
+    # restored files must look newer than their inputs (and each other) to snakemake
+    now = time.time()
+    # links are touched themselves, the files they point to in the cache are shared with other runs
+    for x, dest in enumerate(restored):
+        os.utime(dest, (now+(x*0.001), now+(x*0.001)), follow_symlinks=False)
+
+    if len(restored) > 0:
+        mccutils.log("cache", "restored "+str(len(restored))+" files from: "+entry, log=log)
+
+    return restored
+
+def store(cache_dir, store_name, key, files, max_size=None, log=None):
+    entry, lock_file = get_entry(cache_dir, store_name, key)
+    stored = 0
+    with file_lock(lock_file):
+        mccutils.mkdir(entry)
+        for name, src in files:
+            if os.path.exists(src) and not os.path.exists(entry+name):
+                mccutils.remove(entry+"."+name+".tmp")
+                if is_cached(cache_dir, src):
+                    # files linked from another store (e.g. indexes) are linked again instead of copied
+                    os.symlink(os.path.realpath(src), entry+"."+name+".tmp")
+                else:
+                    shutil.copyfile(src, entry+"."+name+".tmp")
+                os.replace(entry+"."+name+".tmp", entry+name)
+                stored += 1
+
+        touch(entry+LAST_USED)
+
+    if stored > 0:
+        mccutils.log("cache", "stored "+str(stored)+" files in: "+entry, log=log)
+
+    if max_size is not None:
+        evict(cache_dir, store_name, max_size, keep=key, log=log)
+
+def is_cached(cache_dir, infile):
+    # True if infile is a link to a file in the cache
+    return os.path.islink(infile) and os.path.realpath(infile).startswith(os.path.realpath(cache_dir)+"/")
+
+def touch(infile):
+    with open(infile, "a"):
+        os.utime(infile, None)
+
+def get_size(indir):
+    size = 0
+    for root, dirs, files in os.walk(indir):
+        for f in files:
+            # links into other stores are not counted, their files are counted by the store they are in
+            try:
+                size += os.lstat(os.path.join(root, f)).st_size
+            except OSError:
+                pass
+
+    return size
+
+def evict(cache_dir, store_name, max_size, keep=None, log=None):
+    # removes least recently used entries until the store is smaller than max_size (bytes)
+    store_dir = cache_dir+"/"+store_name+"/"
+    with file_lock(store_dir+".evict.lock"):
+        entries = []
+        total_size = 0
+        for entry in os.scandir(store_dir):
+            if not entry.is_dir():
+                continue
+
+            size = get_size(entry.path)
+            total_size += size
+            # <key>.tmp/ directories are builds in progress, held by <key>.lock rather than a lock of their own
+            if entry.name == keep or entry.name.endswith(".tmp"):
+                continue
+
+            if os.path.exists(entry.path+"/"+LAST_USED):
+                last_used = os.path.getmtime(entry.path+"/"+LAST_USED)
+            else:
+                last_used = entry.stat().st_mtime
+            entries.append((last_used, entry.name, size))
+
+        entries.sort()
+        for last_used, key, size in entries:
+            if total_size <= max_size:
+                break
+
+            try:
+                with file_lock(store_dir+key+".lock", blocking=False):
+                    shutil.rmtree(store_dir+key)
+                    total_size -= size
+                    mccutils.log("cache", "evicted: "+store_dir+key, log=log)
+            except BlockingIOError:
+                # entry is in use by another run
+                pass
+
+def get_alignment_key(reference, reads, command, env=None):
+    # reference: the fasta the reads are mapped to, reads: the fastq files
+    # command: the aligner and the parameters that change its output (no file paths or thread counts)
+    # env: the conda env of the aligner, which pins its version
+    key = hashlib.md5()
+    key.update(("reference="+sampled_md5(reference)+"\n").encode())
+    for fq in reads:
+        key.update(("reads="+sampled_md5(fq)+"\n").encode())
+    key.update(("command="+" ".join(command)+"\n").encode())
+    if env is not None:
+        key.update(("env="+file_md5(env)+"\n").encode())
+
+    return key.hexdigest()
+
+def restore_alignments(cache_dir, key, files, log=None):
+    # True if all of the files produced by the alignment were restored from the cache
+    if cache_dir is None or cache_dir == "None":
+        return False
+
+    for f in files:
+        mccutils.remove(f)
+    restore(cache_dir, ALIGNMENT_STORE, key, [(os.path.basename(f), f) for f in files], log=log)
+    for f in files:
+        if not os.path.exists(f):
+            return False
+
+    return True
+
+def store_alignments(cache_dir, key, files, max_size=None, log=None):
+    if cache_dir is None or cache_dir == "None":
+        return
+
+    store(cache_dir, ALIGNMENT_STORE, key, [(os.path.basename(f), f) for f in files], max_size=get_max_size(max_size), log=log)
+
+def get_max_size(max_size):
+    # --cache_max_size (GB) from the run config, in bytes
+    if max_size is None or max_size == "None":
+        return None
+
+    return int(float(max_size) * 1024**3)
+
+@functools.lru_cache(maxsize=None)
+def fasta_md5(fasta, size, mtime):
+    # size and mtime are part of the lru key so a rewritten fasta is digested again
+    return file_md5(fasta)
+
+def get_index_files(index_type, prefix):
+    return [prefix+suffix for suffix in INDEX_FILES[index_type]]
+
+def build_index(commands, files, log=None):
+    for command in commands:
+        if not mccutils.run_command(command, log=log):
+            raise subprocess.CalledProcessError(1, command)
+
+    for index_file in files:
+        mccutils.check_file_exists(index_file)
+
+def get_index(cache_dir, fasta, index_type, files, commands, log=None):
+    # files: the paths the commands write the index to, in the order of INDEX_FILES[index_type]
+    # the index is built once per fasta content and symlinked into each of the methods that use it
+    # old links must not be written through into the cache
+    for index_file in files:
+        mccutils.remove(index_file)
+
+    if cache_dir is None or cache_dir == "None":
+        build_index(commands, files, log=log)
+        return files
+
+    stat = os.stat(fasta)
+    key = hashlib.md5((index_type+"="+fasta_md5(os.path.abspath(fasta), stat.st_size, stat.st_mtime)).encode()).hexdigest()
+    entry, lock_file = get_entry(cache_dir, INDEX_STORE, key)
+    names = [index_type+suffix for suffix in INDEX_FILES[index_type]]
+
+    # concurrent builders of the same index wait here for the first one to publish it
+    with file_lock(lock_file):
+        if not os.path.exists(entry):
+            # a failed build is never published, the files of a partial build are removed
+            try:
+                build_index(commands, files, log=log)
+            except Exception:
+                for index_file in files:
+                    mccutils.remove(index_file)
+                raise
+
+            tmp_entry = entry[:-1]+".tmp/"
+            mccutils.remove(tmp_entry)
+            mccutils.mkdir(tmp_entry)
+            for name, index_file in zip(names, files):
+                shutil.move(index_file, tmp_entry+name)
+            os.rename(tmp_entry, entry)
+            mccutils.log("cache", "stored "+index_type+" index in: "+entry, log=log)
+        else:
+            mccutils.log("cache", "using "+index_type+" index from: "+entry, log=log)
+
+        for name, index_file in zip(names, files):
+            mccutils.remove(index_file)
+            os.symlink(entry+name, index_file)
+        touch(entry+LAST_USED)
+
+    return files
@@ -0,0 +1,16 @@
+import os
+import sys
+sys.path.append(snakemake.config['args']['mcc_path'])
+import scripts.mccutils as mccutils
+
+
+def main():
+    log = snakemake.params.log
+    method = snakemake.wildcards.method
+    mccutils.log("cleanup","removing non-essential "+method+" intermediate files",log=log)
+    mccutils.remove_nonessential(snakemake.params.method_dir, snakemake.params.essential, threads=snakemake.threads)
+    mccutils.log("cleanup",method+" intermediate files removed",log=log)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,12 @@ import os
 import sys
 import subprocess
 import math
+import bisect
+import random
+import itertools
+import json
+import hashlib
+import concurrent.futures
 import argparse
 import numpy as np
 import matplotlib
@@ -16,18 +22,30 @@ spec.loader.exec_module(config)
 
 sys.path.append(snakemake.config['args']['mcc_path'])
 import scripts.mccutils as mccutils
+import scripts.cache as cache
+import scripts.repeatmasker as repeatmasker
 
 
 
 def main():
+    # 0 windows uses the depth of every non-TE position, otherwise at least one window of at least 1bp is needed
+    windows = config.PARAMS["genome_depth_windows"]
+    window_length = config.PARAMS["genome_depth_window_length"]
+    if not isinstance(windows, int) or windows < 0:
+        sys.exit("ERROR: genome_depth_windows: "+str(windows)+" in "+snakemake.params.config+" must be 0 or a number of windows >= 1\n")
+    if not isinstance(window_length, int) or window_length < 1:
+        sys.exit("ERROR: genome_depth_window_length: "+str(window_length)+" in "+snakemake.params.config+" must be >= 1\n")
+
     mcc_out = snakemake.config["args"]['out']
     mccutils.mkdir(mcc_out+"/results/")
     coverage_out = mcc_out+"/results/coverage/"
     mccutils.mkdir(coverage_out)
 
     # ensures intermediate files from previous runs are removed
+    # plots are kept so that families with unchanged coverage are not plotted again
     for f in os.listdir(coverage_out):
-        mccutils.remove(coverage_out+"/"+f)
+        if f != "plots":
+            mccutils.remove(coverage_out+"/"+f)
 
     run_id = snakemake.config['args']['run_id']
     te_seqs = snakemake.input.consensus
@@ -35,7 +53,6 @@ def main():
     
     # always use consensus fasta for masking the genome
     mccutils.mkdir(coverage_out+"/input")
-    mccutils.mkdir(coverage_out+"/te-depth-files")
     masked_reference, masked_gff = repeatmask_genome(snakemake.input.ref, te_seqs, snakemake.threads, run_id, coverage_out, log)
 
     # uses coverage fasta (if exists) for augmenting and coverage analysis
@@ -54,7 +71,7 @@ def main():
 
     bam = sam_to_bam(sam, augmented_reference, snakemake.params.sample, snakemake.threads, run_id, coverage_out, log)
     nonte_bed = make_nonte_bed(snakemake.input.ref, masked_gff, run_id, coverage_out, log)
-    genome_depth = get_genome_depth(nonte_bed, bam, run_id, coverage_out, log)
+    genome_depth = get_genome_depth(nonte_bed, bam, run_id, coverage_out, log, windows=windows, window_length=window_length)
 
     edge_trim = 0
     if config.PARAMS["omit_edges"]:
@@ -63,8 +80,8 @@ def main():
         else:
             edge_trim = config.PARAMS["omit_edges_length"]
             
-    te_names, all_coverage_files, uniq_coverage_files, avg_norm_te_depths = make_depth_table(te_seqs, bam, genome_depth, run_id, coverage_out, snakemake.output[0], log, trim_edges=edge_trim)
-    make_plots(te_names, all_coverage_files, uniq_coverage_files, avg_norm_te_depths, genome_depth, snakemake.params.sample, coverage_out, trim_edges=edge_trim)
+    te_names, all_depths, uniq_depths, avg_norm_te_depths = make_depth_table(te_seqs, bam, augmented_reference, genome_depth, run_id, coverage_out, snakemake.output[0], log, trim_edges=edge_trim, threads=snakemake.threads)
+    make_plots(te_names, all_depths, uniq_depths, avg_norm_te_depths, genome_depth, snakemake.params.sample, coverage_out, trim_edges=edge_trim, threads=snakemake.threads, dpi=config.PARAMS["plot_dpi"], plot_format=config.PARAMS["plot_format"])
 
     mccutils.remove(sam)
 
@@ -72,14 +89,8 @@ def main():
 def repeatmask_genome(reference, lib, threads, run_id, out, log):
     mccutils.log("coverage","Running RepeatMasker",log=log)
     outdir = out+"/input/repeatmasker_"+run_id
-    mccutils.mkdir(outdir)
-    os.chdir(outdir)
-    ref_name = os.path.basename(reference)
-    command = ["RepeatMasker","-pa", str(threads), "-lib", lib, "-dir", outdir, "-s", "-gff", "-nolow", "-no_is", reference]
-    mccutils.run_command(command, log=log)
-
-    masked_fasta = outdir+"/"+ref_name+".masked"
-    repeat_masker_gff = outdir+"/"+ref_name+".out.gff"
+    mcc_args = snakemake.config['args']
+    repeat_masker_out, repeat_masker_gff, masked_fasta = repeatmasker.repeatmask(reference, lib, threads, outdir, mcc_args['cache'], mcc_args['out'], max_size=mcc_args['cache_max_size'], log=log)
 
     return masked_fasta, repeat_masker_gff
 
@@ -112,8 +123,9 @@ def augment_genome(fasta1, fasta2, out):
 
 def index_genome(fasta, log):
     mccutils.log("coverage","samtools and bwa indexing reference", log=log)
-    mccutils.run_command(["samtools", "faidx", fasta], log=log)
-    mccutils.run_command(["bwa", "index", fasta], log=log)
+    cache_dir = snakemake.config['args']['cache']
+    cache.get_index(cache_dir, fasta, "faidx", cache.get_index_files("faidx", fasta), [["samtools", "faidx", fasta]], log=log)
+    cache.get_index(cache_dir, fasta, "bwa", cache.get_index_files("bwa", fasta), [["bwa", "index", fasta]], log=log)
 
 
 def map_reads(reference, fq1, threads, sample_name, run_id, out, log, fq2=None):
@@ -195,137 +207,290 @@ def repeatmasker_gff_to_bed(gff, bed):
                     outbed.write(out_line+"\n")
 
 
-def get_genome_depth(non_te_bed, bam, run_id, out, log):
+def get_genome_depth(non_te_bed, bam, run_id, out, log, windows=0, window_length=10000):
     mccutils.log("coverage","determining the coverage depth of the genome", log=log)
-    depth_file = out+"/input/"+run_id+"genome.depth"
-    command = ["samtools", "depth", "-aa", "-b", non_te_bed, bam, "-d", "0"]
-    mccutils.run_command_stdout(command, depth_file, log=log)
+    if windows > 0:
+        return estimate_genome_depth(non_te_bed, bam, run_id, out, log, windows, window_length)
 
-    genome_depth = get_avg_depth(depth_file)
+    # samtools depth output is summed as it is read, in blocks, so memory use does not depend on genome size
+    command = ["samtools", "depth", "-aa", "-b", non_te_bed, bam, "-d", "0"]
+    total = 0
+    positions = 0
+    with open(log, "a") as l:
+        l.write(" ".join(command)+"\n")
+        l.flush()
+        proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=l)
+        remainder = b""
+        for block in iter(lambda: proc.stdout.read(8388608), b""):
+            block = remainder+block
+            last_line = block.rfind(b"\n")+1
+            remainder = block[last_line:]
+            fields = block[:last_line].split()
+            total += sum(map(int, fields[2::3]))
+            positions += len(fields)//3
+        proc.stdout.close()
+
+        if proc.wait() != 0:
+            sys.exit("ERROR: "+" ".join(command)+" failed, check the log file: "+log+"\n")
 
-    mccutils.remove(depth_file)
+    if positions > 0:
+        genome_depth = total/positions
+    else:
+        mccutils.log("coverage", "ERROR: no non-TE positions in: "+non_te_bed, log=log)
+        genome_depth = 0
 
     return genome_depth
 
 
-def get_avg_depth(depth_file, trim_edges=0):
-    total = 0
-    positions = 0
+def estimate_genome_depth(non_te_bed, bam, run_id, out, log, windows, window_length):
+    # mean depth of randomly placed windows in the non-TE regions, from the sum of the depths reported by samtools bedcov
+    # bedcov reads only the windows through the BAM index, so the time taken does not depend on genome size
+    intervals = []
+    total_length = 0
+    with open(non_te_bed, "r") as bed:
+        for line in bed:
+            split_line = line.split("\t")
+            start = int(split_line[1])
+            end = int(split_line[2])
+            if end > start:
+                intervals.append((split_line[0], start, end))
+                total_length += end-start
+
+    window_bed = out+"/input/"+run_id+"_genome_depth_windows.bed"
+    rand = random.Random(0)
+    interval_ends = list(itertools.accumulate([end-start for chrom, start, end in intervals]))
+    with open(window_bed, "w") as bed:
+        for x in range(windows):
+            if total_length < 1:
+                break
+            point = rand.randrange(total_length)
+            interval = bisect.bisect_right(interval_ends, point)
+            chrom, start, end = intervals[interval]
+            window_start = start + point - (interval_ends[interval]-(end-start))
+            window_end = min(window_start+window_length, end)
+            bed.write("\t".join([chrom, str(window_start), str(window_end)])+"\n")
+
+    window_depths = []
+    window_lengths = []
+    command = ["samtools", "bedcov", window_bed, bam]
+    with open(log, "a") as l:
+        l.write(" ".join(command)+"\n")
+        l.flush()
+        proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=l)
+        for line in proc.stdout:
+            split_line = line.split(b"\t")
+            length = int(split_line[2])-int(split_line[1])
+            window_depths.append(int(split_line[-1])/length)
+            window_lengths.append(length)
+        proc.stdout.close()
+
+        if proc.wait() != 0:
+            sys.exit("ERROR: "+" ".join(command)+" failed, check the log file: "+log+"\n")
+
+    mccutils.remove(window_bed)
+
+    if len(window_depths) < 1:
+        mccutils.log("coverage", "no windows could be placed in: "+non_te_bed+", using the depth of every non-TE position", log=log)
+        return get_genome_depth(non_te_bed, bam, run_id, out, log, windows=0)
+
+    window_depths = np.array(window_depths)
+    window_lengths = np.array(window_lengths)
+    genome_depth = float(np.sum(window_depths*window_lengths)/np.sum(window_lengths))
+
+    # the confidence interval needs at least two windows
+    if len(window_depths) < 2:
+        mccutils.log("coverage", "estimated genome depth from 1 window: "+str(round(genome_depth,2)), log=log)
+        return genome_depth
+
+    margin = 1.96*float(np.std(window_depths, ddof=1))/math.sqrt(len(window_depths))
+    mccutils.log("coverage", "estimated genome depth from "+str(len(window_depths))+" windows: "+str(round(genome_depth,2))+" (95% CI: "+str(round(genome_depth-margin,2))+"-"+str(round(genome_depth+margin,2))+")", log=log)
 
-    depth_lines = []
-    with open(depth_file, "r") as depth:
-        for line in depth:
-            depth_lines.append(line)
-    
-    for x in range(trim_edges, len(depth_lines)-trim_edges):
-            line = depth_lines[x]
-            positions += 1
+    return genome_depth
+
+
+def get_te_depths(te_names, bam, reference, run_id, out, log, threads=1):
+    # the reads on the TE contigs are extracted once through the BAM index, so the genome reads are never read
+    # concurrent MAPQ>=0 and MAPQ>=1 samtools depth processes then read only those reads
+    # both processes visit the same positions in the same order, so their lines are read in pairs
+    mccutils.log("coverage","calculating the coverage depth of the TE families", log=log)
+    te_lengths = {}
+    with open(reference+".fai", "r") as faidx:
+        for line in faidx:
             split_line = line.split("\t")
-            total += int(split_line[2])
-    
-    if positions > 0:
-        avg_depth = total/positions
+            te_lengths[split_line[0]] = int(split_line[1])
+
+    te_bed = out+"/input/"+run_id+"_te_contigs.bed"
+    all_depths = {}
+    uniq_depths = {}
+    with open(te_bed, "w") as bed:
+        for te_name in te_names:
+            bed.write("\t".join([te_name, "0", str(te_lengths[te_name])])+"\n")
+            all_depths[te_name] = np.zeros(te_lengths[te_name], dtype=np.int64)
+            uniq_depths[te_name] = np.zeros(te_lengths[te_name], dtype=np.int64)
+
+    te_bam = out+"/input/"+run_id+"_te_contigs.bam"
+    command = ["samtools", "view", "-b", "-@", str(threads), "-o", te_bam, bam] + te_names
+    if not mccutils.run_command(command, log=log):
+        sys.exit("ERROR: unable to extract the TE contig reads from: "+bam+", check the log file: "+log+"\n")
+    if not mccutils.run_command(["samtools", "index", te_bam], log=log):
+        sys.exit("ERROR: unable to index: "+te_bam+", check the log file: "+log+"\n")
+
+    commands = [
+        ["samtools", "depth", "-aa", "-b", te_bed, te_bam, "-d", "0", "-Q", "0"],
+        ["samtools", "depth", "-aa", "-b", te_bed, te_bam, "-d", "0", "-Q", "1"]
+    ]
+    with open(log, "a") as l:
+        for command in commands:
+            l.write(" ".join(command)+"\n")
+        l.flush()
+        procs = [subprocess.Popen(command, stdout=subprocess.PIPE, stderr=l) for command in commands]
+
+        try:
+            chrom = None
+            for all_line, uniq_line in zip(procs[0].stdout, procs[1].stdout):
+                all_chrom, all_pos, all_depth = all_line.split(b"\t")
+                uniq_chrom, uniq_pos, uniq_depth = uniq_line.split(b"\t")
+                if all_chrom != uniq_chrom or all_pos != uniq_pos:
+                    sys.exit("ERROR: samtools depth outputs are out of sync at: "+all_chrom.decode()+":"+all_pos.decode()+"\n")
+
+                if all_chrom != chrom:
+                    chrom = all_chrom
+                    all_depth_array = all_depths[chrom.decode()]
+                    uniq_depth_array = uniq_depths[chrom.decode()]
+
+                pos = int(all_pos)-1
+                all_depth_array[pos] = int(all_depth)
+                uniq_depth_array[pos] = int(uniq_depth)
+
+        finally:
+            for proc in procs:
+                proc.stdout.close()
+
+        for command, proc in zip(commands, procs):
+            if proc.wait() != 0:
+                sys.exit("ERROR: "+" ".join(command)+" failed, check the log file: "+log+"\n")
+
+    for f in [te_bed, te_bam, te_bam+".bai"]:
+        mccutils.remove(f)
+
+    return all_depths, uniq_depths
+
+
+def get_avg_array_depth(te_name, depths, trim_edges=0):
+    trimmed = depths[trim_edges:len(depths)-trim_edges]
+    if len(trimmed) > 0:
+        avg_depth = float(np.mean(trimmed))
     else:
-        mccutils.log("coverage", "ERROR: no positions in: "+depth_file)
-        mccutils.log("coverage", "It's likely the length of the family for: "+depth_file+" is shorter than the trimmed edges parameter")
+        mccutils.log("coverage", "ERROR: no positions in: "+te_name)
+        mccutils.log("coverage", "It's likely the length of the family: "+te_name+" is shorter than the trimmed edges parameter")
         mccutils.log("coverage", "Setting avg depth to zero for this family, to avoid this, lower the OMIT_EDGES_LENGTH parameter in the coverage config file")
         avg_depth = 0
 
     return avg_depth
 
-def make_depth_table(te_fasta, bam, genome_depth, run_id, out, depth_csv, log, trim_edges=0):
+
+def write_depth_container(te_names, all_depths, uniq_depths, genome_depth, out_file):
+    # every family's depths in two concatenated arrays, family x is at offsets[x]:offsets[x+1]
+    # normalized depths are the raw depths divided by genome_depth
+    offsets = np.zeros(len(te_names)+1, dtype=np.int64)
+    for x, te_name in enumerate(te_names):
+        offsets[x+1] = offsets[x]+len(all_depths[te_name])
+
+    np.savez(out_file,
+        families=np.array(te_names),
+        offsets=offsets,
+        allQ=np.concatenate([all_depths[te_name] for te_name in te_names]+[np.zeros(0)]).astype(np.int32),
+        highQ=np.concatenate([uniq_depths[te_name] for te_name in te_names]+[np.zeros(0)]).astype(np.int32),
+        genome_depth=np.float64(genome_depth)
+    )
+
+
+def make_depth_table(te_fasta, bam, reference, genome_depth, run_id, out, depth_csv, log, trim_edges=0, threads=1):
     mccutils.log("coverage","creating TE depth coverage table", log=log)
-    with open(depth_csv, "w") as table:
-            table.write("TE-Family,Normalized-Depth,Normalized-Unique-Depth"+"\n")
-    
     te_names = []
-    uniq_coverage_files = []
-    all_coverage_files = []
-    avg_norm_depths = []
-    avg_uniq_norm_depths = []
-
     with open(te_fasta,"r") as fa:
         for line in fa:
             if ">" in line:
                 te_name = line.replace("\n","")
                 te_name = te_name.replace(">","")
-
-                mccutils.mkdir(out+"/te-depth-files")
-                highQ = out+"/te-depth-files/"+te_name+".highQ.cov"
-                command = ["samtools", "depth", "-aa", "-r", te_name, bam, "-d", "0", "-Q", "1"]
-                mccutils.run_command_stdout(command, highQ, log=log)
-
-                allQ = out+"/te-depth-files/"+te_name+".allQ.cov"
-                command = ["samtools", "depth", "-aa", "-r", te_name, bam, "-d", "0", "-Q", "0"]
-                mccutils.run_command_stdout(command, allQ, log=log)
-
-                # make normalized coverage files
-                allQ_chrom, allQ_pos, allQ_cov = read_samtools_depth_file(allQ)
-                with open(out+"/te-depth-files/"+te_name+".allQ.normalized.cov","w") as covfile:
-                    for i,pos in enumerate(allQ_pos):
-                        cov = str(round(allQ_cov[i]/genome_depth,2))
-                        line = "\t".join([allQ_chrom,str(pos),cov])
-                        covfile.write(line+"\n")
-                
-                highQ_chrom, highQ_pos, highQ_cov = read_samtools_depth_file(highQ)
-                with open(out+"/te-depth-files/"+te_name+".highQ.normalized.cov","w") as covfile:
-                    for i,pos in enumerate(highQ_pos):
-                        cov = str(round(highQ_cov[i]/genome_depth,2))
-                        line = "\t".join([highQ_chrom,str(pos),cov])
-                        covfile.write(line+"\n")
-
-                avg_depth = get_avg_depth(allQ, trim_edges=trim_edges)
-                avg_norm_depth = avg_depth/genome_depth
-
-                avg_uniq_depth = get_avg_depth(highQ, trim_edges=trim_edges)
-                avg_uniq_norm_depth = avg_uniq_depth/genome_depth
-
-                with open(depth_csv, "a") as table:
-                    table.write(te_name+","+str(round(avg_norm_depth,2))+","+str(round(avg_uniq_norm_depth,2))+"\n")
-    
                 te_names.append(te_name)
-                uniq_coverage_files.append(highQ)
-                all_coverage_files.append(allQ)
-                avg_norm_depths.append(avg_norm_depth)
-    
-    return te_names, all_coverage_files, uniq_coverage_files, avg_norm_depths
 
+    all_depths, uniq_depths = get_te_depths(te_names, bam, reference, run_id, out, log, threads=threads)
+
+    write_depth_container(te_names, all_depths, uniq_depths, genome_depth, out+"/te_depth.npz")
 
-def make_plots(te_names, all_coverage_files, uniq_coverage_files, avg_norm_te_depths, genome_depth, sample_name, out, trim_edges=0):
+    avg_norm_depths = []
+    table_lines = ["TE-Family,Normalized-Depth,Normalized-Unique-Depth\n"]
+    for te_name in te_names:
+        avg_norm_depth = get_avg_array_depth(te_name, all_depths[te_name], trim_edges=trim_edges)/genome_depth
+        avg_uniq_norm_depth = get_avg_array_depth(te_name, uniq_depths[te_name], trim_edges=trim_edges)/genome_depth
+        table_lines.append(te_name+","+str(round(avg_norm_depth,2))+","+str(round(avg_uniq_norm_depth,2))+"\n")
+        avg_norm_depths.append(avg_norm_depth)
+
+    with open(depth_csv, "w") as table:
+        table.write("".join(table_lines))
+
+    return te_names, all_depths, uniq_depths, avg_norm_depths
+
+
+def make_plots(te_names, all_depths, uniq_depths, avg_norm_te_depths, genome_depth, sample_name, out, trim_edges=0, threads=1, dpi=300, plot_format="png"):
     mccutils.log("coverage","creating TE coverage plots")
-    mccutils.mkdir(out+"/plots")
+    plot_dir = out+"/plots/"
+    mccutils.mkdir(plot_dir)
+    hash_file = plot_dir+".plot_hashes.json"
+    old_hashes = {}
+    if os.path.exists(hash_file):
+        with open(hash_file, "r") as hashes:
+            old_hashes = json.load(hashes)
+
+    plot_hashes = {}
+    plots = []
     for x, te_name in enumerate(te_names):
-        chrom, all_pos, all_cov = read_samtools_depth_file(all_coverage_files[x])
-        chrom2, uniq_pos, uniq_cov = read_samtools_depth_file(uniq_coverage_files[x])
+        output = plot_dir+te_name+"."+plot_format
+        plot_args = (te_name, all_depths[te_name], uniq_depths[te_name], sample_name, genome_depth, avg_norm_te_depths[x], trim_edges, dpi, output)
+        plot_hashes[te_name] = get_plot_hash(plot_args)
+        if old_hashes.get(te_name) == plot_hashes[te_name] and os.path.exists(output):
+            mccutils.log("coverage","coverage unchanged, skipping plot: "+output)
+        else:
+            plots.append(plot_args)
+
+    # removes plots of families that are no longer in the coverage fasta, or of another format
+    outputs = set([te_name+"."+plot_format for te_name in te_names])
+    for f in os.listdir(plot_dir):
+        if f not in outputs and f != os.path.basename(hash_file):
+            mccutils.remove(plot_dir+f)
+
+    if threads > 1 and len(plots) > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(threads, len(plots))) as executor:
+            for output in executor.map(make_plot, plots, chunksize=max(1, len(plots)//(threads*4))):
+                mccutils.log("coverage","plot created: "+output)
+    else:
+        for plot_args in plots:
+            output = make_plot(plot_args)
+            mccutils.log("coverage","plot created: "+output)
 
-        plot_height = 3
-        plot_width = 10
-        hline = avg_norm_te_depths[x]
-        output = out+"plots/"+te_name+".png"
-        plot = plot_coverage(chrom, all_pos, all_cov, uniq_pos, uniq_cov, sample_name, plot_height, plot_width, genome_depth, hline, trim_edges=trim_edges)
-        plot.savefig(output, bbox_inches="tight")
-        plot.close()
-        mccutils.log("coverage","plot created: "+output)
+    with open(hash_file, "w") as hashes:
+        json.dump(plot_hashes, hashes)
 
 
+def get_plot_hash(plot_args):
+    te_name, all_cov, uniq_cov, sample_name, genome_depth, hline, trim_edges, dpi, output = plot_args
+    plot_hash = hashlib.md5(all_cov.tobytes())
+    plot_hash.update(uniq_cov.tobytes())
+    plot_hash.update(repr((te_name, sample_name, genome_depth, hline, trim_edges, dpi, output)).encode())
+    return plot_hash.hexdigest()
 
-def read_samtools_depth_file(depth_file):
-    chrom = ""
-    x = []
-    y = []
-    
-    with open(depth_file,"r") as depth:
-        for line in depth:
-            split_line = line.split("\t")
-            if chrom == "":
-                chrom = split_line[0]
-            elif chrom != split_line[0]:
-                sys.exit("Error: Samtools depth file has multiple reference contigs.... exiting...\n")
-            
-            x.append(int(split_line[1]))
-            y.append(int(split_line[2]))
 
-    return chrom, x, y
+def make_plot(plot_args):
+    te_name, all_cov, uniq_cov, sample_name, genome_depth, hline, trim_edges, dpi, output = plot_args
+    positions = list(range(1, len(all_cov)+1))
+    plot_height = 3
+    plot_width = 10
+    plot = plot_coverage(te_name, positions, all_cov, positions, uniq_cov, sample_name, plot_height, plot_width, genome_depth, hline, trim_edges=trim_edges)
+    plot.savefig(output, bbox_inches="tight", dpi=dpi)
+    plot.close()
+    return output
+
 
 
 def plot_coverage(chrom, all_pos, all_cov, uniq_pos, uniq_cov, title, height, width, normalize_cov, add_hline, trim_edges=0 ):
@@ -0,0 +1,37 @@
+import os
+import sys
+sys.path.append(snakemake.config['args']['mcc_path'])
+import scripts.mccutils as mccutils
+
+
+def main():
+    log = snakemake.params.log
+    shard_dirs = snakemake.params.shard_dirs
+    shard_chromosomes = []
+    for manifest in snakemake.params.shard_manifests:
+        shard_chromosomes.append(mccutils.get_chromosomes(manifest))
+
+    mccutils.log("gather","merging results from "+str(len(shard_dirs))+" shards", log=log)
+    for out_file in snakemake.output:
+        shard_files = []
+        for shard_dir, chromosomes in zip(shard_dirs, shard_chromosomes):
+            shard_files.append((shard_dir+os.path.basename(out_file), chromosomes))
+        mccutils.merge_shard_files(shard_files, out_file, header_lines=snakemake.params.header_lines)
+
+    failed_shards = []
+    for shard_dir in shard_dirs:
+        if not mccutils.check_status_file(shard_dir+snakemake.params.shard_status):
+            failed_shards.append(shard_dir)
+
+    with open(snakemake.params.status_log, "w") as l:
+        if len(failed_shards) > 0:
+            l.write("FAILED\n")
+            mccutils.log("gather","run failed for shards: "+" ".join(failed_shards), log=log)
+        else:
+            l.write("COMPLETED\n")
+
+    mccutils.log("gather","shard results merged", log=log)
+
+
+if __name__ == "__main__":
+    main()
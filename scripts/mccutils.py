@@ -6,7 +6,8 @@ import hashlib
 import socket
 import shutil
 import errno
-import statistics
+import gzip
+import concurrent.futures
 from datetime import date
 
 
@@ -138,6 +139,58 @@ def run_command(cmd_list, log=None, fatal=False):
     
     return True
 
+def run_pipeline(cmd_lists, out_file=None, log=None):
+    # runs the commands connected by pipes (cmd1 | cmd2 | ...) without writing the intermediate streams to disk
+    # returns False if any of the commands fail
+    cmd_string = " | ".join([" ".join(cmd_list) for cmd_list in cmd_lists])
+    if out_file is not None:
+        cmd_string += " > "+out_file
+
+    if log is None:
+        err = None
+    else:
+        err = open(log,"a")
+        err.write(cmd_string+"\n")
+        err.flush()
+
+    out = None
+    if out_file is not None:
+        out = open(out_file,"w")
+
+    procs = []
+    try:
+        for x, cmd_list in enumerate(cmd_lists):
+            stdin = None
+            if x > 0:
+                stdin = procs[-1].stdout
+            stdout = subprocess.PIPE
+            if x == len(cmd_lists)-1:
+                stdout = out
+            procs.append(subprocess.Popen(cmd_list, stdin=stdin, stdout=stdout, stderr=err))
+            if x > 0:
+                # lets the upstream command receive SIGPIPE if this one exits
+                procs[-2].stdout.close()
+
+        failed = [cmd_lists[x] for x, proc in enumerate(procs) if proc.wait() != 0]
+
+    finally:
+        for proc in procs:
+            if proc.poll() is None:
+                proc.kill()
+        if out is not None:
+            out.close()
+        if err is not None:
+            err.close()
+
+    if len(failed) > 0:
+        msg = "failed: "+" ".join(failed[0])+"\n"+cmd_string+"\n"
+        writelog(log, msg)
+        sys.stderr.write(msg)
+        return False
+
+    return True
+
+
 def writelog(log, msg):
     if log is not None:
         with open(log, "a") as out:
@@ -190,34 +243,150 @@ def remove(infile):
             print("Error: %s : %s" % (infile, e.strerror))
 
 
-def get_median_insert_size(infile):
-    median_insert_size = 0
+def remove_nonessential(indir, keep_paths, threads=1, remove_root=False):
+    # keep_paths: files to keep (exact paths) and directories to keep (paths ending in "/")
+    # sub-directories that contain nothing to keep are removed whole, without walking them
+    if not os.path.exists(indir):
+        return
+
+    keep_files = set()
+    keep_dirs = []
+    for keep_path in keep_paths:
+        if keep_path.endswith("/") or os.path.isdir(keep_path):
+            keep_dirs.append(os.path.abspath(keep_path)+"/")
+        else:
+            keep_files.add(os.path.abspath(keep_path))
+    keep_dirs = tuple(keep_dirs)
+
+    # every directory that has something to keep below it
+    keep_parents = set()
+    for keep_path in list(keep_files) + [d[:-1] for d in keep_dirs]:
+        parent = os.path.dirname(keep_path)
+        while parent not in keep_parents and parent != os.path.dirname(parent):
+            keep_parents.add(parent)
+            parent = os.path.dirname(parent)
+
+    root = os.path.abspath(indir)
+    if (root+"/").startswith(keep_dirs):
+        return
+
+    to_remove = []
+    walked_dirs = []
+    to_walk = [root]
+    while len(to_walk) > 0:
+        current_dir = to_walk.pop()
+        walked_dirs.append(current_dir)
+        with os.scandir(current_dir) as entries:
+            for entry in entries:
+                path = os.path.normpath(entry.path)
+                if entry.is_dir(follow_symlinks=False):
+                    if (path+"/").startswith(keep_dirs):
+                        continue
+                    elif path in keep_parents:
+                        to_walk.append(path)
+                    else:
+                        to_remove.append(path)
+                elif path not in keep_files and not path.startswith(keep_dirs):
+                    to_remove.append(path)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+        list(executor.map(remove, to_remove))
+
+    # directories were walked top-down, so reversing removes children before their parents
+    if not remove_root:
+        walked_dirs = walked_dirs[1:]
+    for walked_dir in reversed(walked_dirs):
+        try:
+            os.rmdir(walked_dir)
+        except OSError:
+            # still has files that are kept
+            pass
+
+
+INSERT_SIZE_PERCENTILES = [5, 25, 75, 95]
+
+def get_insert_size_metrics(infile):
+    # metrics file written by the median_insert_size rule: one key=value per line
+    metrics = {}
     with open(infile,"r") as inf:
         for line in inf:
-            insert = line.split("=")[1]
-            insert = insert.replace("\n","")
-            median_insert_size = int(float(insert))
-    
+            if "=" in line:
+                key, val = line.replace("\n","").split("=")[:2]
+                metrics[key] = float(val)
+
+    return metrics
+
+def get_median_insert_size(infile):
+    metrics = get_insert_size_metrics(infile)
+    median_insert_size = int(metrics.get("median_insert_size", 0))
+
     return median_insert_size
 
-def calc_median_insert_size(insam):
-    insert_sizes = []
-    with open(insam,"r") as sam:
-        for line in sam:
-            split_line = line.split("\t")
-            if len(split_line) >= 8:
-                insert_size = int(split_line[8])
-                if insert_size > 0:
-                    insert_sizes.append(insert_size)
+def write_insert_size_metrics(metrics, out_file):
+    with open(out_file,"w") as out:
+        for key, val in metrics.items():
+            out.write(key+"="+str(val)+"\n")
+
+def insert_size_histogram(sam_lines, max_pairs=None):
+    # counts of each insert size, memory only grows with the number of distinct insert sizes
+    # each pair is counted once, from the mate with the positive template length
+    histogram = {}
+    pairs = 0
+    for line in sam_lines:
+        if line[0] == "@":
+            continue
+        split_line = line.split("\t", 9)
+        if len(split_line) > 8:
+            insert_size = int(split_line[8])
+            if insert_size > 0:
+                histogram[insert_size] = histogram.get(insert_size, 0) + 1
+                pairs += 1
+                if max_pairs is not None and pairs >= max_pairs:
+                    break
+
+    return histogram
+
+def histogram_percentile(histogram, percentile):
+    # nearest-rank percentile, the median of an even number of values is the mean of the middle two (as statistics.median)
+    total = sum(histogram.values())
+    if percentile == 50 and total%2 == 0:
+        return (histogram_rank(histogram, total//2) + histogram_rank(histogram, (total//2)+1))/2
     
-    if len(insert_sizes) < 1:
+    rank = max(1, -(-(total*percentile)//100))
+    return histogram_rank(histogram, rank)
+
+def histogram_rank(histogram, rank):
+    seen = 0
+    for val in sorted(histogram.keys()):
+        seen += histogram[val]
+        if seen >= rank:
+            return val
+
+def calc_insert_size_metrics(histogram):
+    if len(histogram) < 1:
         raise insertSizeError("Can't calculate median insert size due to lack of valid insert size values")
-        return 0
 
-    insert_sizes.sort()
-    median = statistics.median(insert_sizes)
+    median = histogram_percentile(histogram, 50)
+    deviations = {}
+    for val, count in histogram.items():
+        deviation = abs(val-median)
+        deviations[deviation] = deviations.get(deviation, 0) + count
+
+    metrics = {
+        "median_insert_size": median,
+        "insert_size_mad": histogram_percentile(deviations, 50),
+        "pairs": sum(histogram.values())
+    }
+    for percentile in INSERT_SIZE_PERCENTILES:
+        metrics["insert_size_p"+str(percentile)] = histogram_percentile(histogram, percentile)
 
-    return median
+    return metrics
+
+def calc_median_insert_size(insam, max_pairs=None):
+    with open(insam,"r") as sam:
+        histogram = insert_size_histogram(sam, max_pairs=max_pairs)
+    
+    return calc_insert_size_metrics(histogram)["median_insert_size"]
 
 def check_file_exists(infile):
     if os.path.exists(infile):
@@ -242,9 +411,75 @@ def replace_special_chars(string, encode="_"):
     return string
 
 
+def reference_args(alignments, reference):
+    # CRAM (--cram) is decoded against the reference fasta
+    if alignments.split(".")[-1] == "cram":
+        return ["--reference", reference]
+
+    return []
+
+
+def get_chromosomes(chromosome_manifest):
+    # manifest is a tab-separated file of chromosome names and lengths in reference order
+    chromosomes = {}
+    with open(chromosome_manifest, "r") as manifest:
+        for line in manifest:
+            split_line = line.replace("\n","").split("\t")
+            if len(split_line) == 2:
+                chromosomes[split_line[0]] = int(split_line[1])
+
+    return chromosomes
+
+
+def merge_shard_files(shard_files, out_file, header_lines=0, comment="#"):
+    # shard_files: list of (path, chromosomes of the shard), results outside the shard's chromosomes are dropped
+    # the header is taken from the first shard that has one
+    header_written = False
+    with open(out_file, "w") as outf:
+        for shard_file, chromosomes in shard_files:
+            has_header = False
+            with open(shard_file, "r") as inf:
+                for x, line in enumerate(inf):
+                    if x < header_lines or line.startswith(comment):
+                        has_header = True
+                        if not header_written:
+                            outf.write(line)
+                    elif chromosomes is None or line.split("\t")[0] in chromosomes:
+                        outf.write(line)
+
+            if has_header:
+                header_written = True
+
+
+def open_file(infile, mode="r"):
+    # reads kept compressed by --compress_reads are opened transparently
+    if infile.split(".")[-1] == "gz":
+        return gzip.open(infile, mode+"t")
+
+    return open(infile, mode)
+
+
+def plain_fastq(fq, out_fq, threads=1, log=None):
+    # for tools that can't read compressed fastq: decompresses fq to out_fq, or links it if it is already plain text
+    remove(out_fq)
+    if fq.split(".")[-1] != "gz":
+        os.symlink(fq, out_fq)
+        return out_fq
+
+    if shutil.which("pigz") is not None:
+        command = ["pigz", "-dc", "-p", str(threads), fq]
+    else:
+        command = ["gzip", "-dc", fq]
+
+    if not run_command_stdout(command, out_fq, log=log):
+        raise OSError("unable to decompress: "+fq)
+
+    return out_fq
+
+
 def estimate_read_length(fq, reads=10000):
     lengths = []
-    with open(fq,"r") as f:
+    with open_file(fq,"r") as f:
         for x, line in enumerate(f):
             if x%4 == 1:
                 lengths.append(len(line.replace('\n',"")))
@@ -20,7 +20,7 @@ def main():
     log = snakemake.params.log
     sample_name = snakemake.params.sample_name
     out_dir = snakemake.params.out_dir
-    chromosomes = snakemake.params.chromosomes.split(",")
+    chromosomes = mccutils.get_chromosomes(snakemake.params.chromosomes)
     status_log = snakemake.params.status_log
     vcf_options = snakemake.params.vcf.split(",")
 
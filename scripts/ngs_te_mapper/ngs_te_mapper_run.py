@@ -43,6 +43,13 @@ def main():
         if snakemake.params.raw_fq2 == "None":
             is_paired = False
         
+        # ngs_te_mapper only reads plain text fastq, reads kept compressed are decompressed here
+        if fastq1.split(".")[-1] == "gz":
+            mccutils.mkdir(out_dir+"/input/")
+            fastq1 = mccutils.plain_fastq(fastq1, out_dir+"/input/"+os.path.basename(fastq1)[:-3], threads=threads, log=log)
+            if is_paired:
+                fastq2 = mccutils.plain_fastq(fastq2, out_dir+"/input/"+os.path.basename(fastq2)[:-3], threads=threads, log=log)
+
         command = ['Rscript', "--vanilla", script_dir+"/ngs_te_mapper.R", "genome="+reference_fasta, "teFile="+consensus_fasta, "tsd="+str(config.PARAMS["tsd="]), "thread="+str(threads), "output="+out_dir, "sourceCodeFolder="+script_dir]
 
         if is_paired:
@@ -52,6 +59,7 @@ def main():
         
         mccutils.log("ngs_te_mapper","running ngs_te_mapper", log=log)
         mccutils.run_command(command, log=log)
+        mccutils.remove(out_dir+"/input/")
         mccutils.log("ngs_te_mapper","ngs_te_mapper run complete", log=log)
 
         raw_bed = ""
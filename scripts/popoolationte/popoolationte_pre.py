@@ -4,6 +4,7 @@ import subprocess
 import traceback
 sys.path.append(snakemake.config['args']['mcc_path'])
 import scripts.mccutils as mccutils
+import scripts.cache as cache
 
 
 
@@ -26,8 +27,20 @@ def main():
         for f in os.listdir(out_dir):
             mccutils.remove(out_dir+"/"+f)
 
+        # read names are rewritten with the sample name before mapping, so it is part of the key
+        cache_dir = snakemake.config['args']['cache']
+        if cache_dir != "None":
+            key = cache.get_alignment_key(ref_fasta, [fq1, fq2], ["bwa", "bwasw", "samro.pl", sample_name], env=snakemake.config['envs']['popoolationte'])
+
         mccutils.log("popoolationte","formatting read names")
         fq1,fq2 = format_read_names(fq1, fq2, sample_name, out_dir)
+
+        if cache_dir != "None" and cache.restore_alignments(cache_dir, key, [snakemake.output[2]], log=log):
+            with open(status_log,"w") as l:
+                l.write("COMPLETED\n")
+            mccutils.log("popoolationte","PopoolationTE preprocessing complete")
+            return
+
         mccutils.log("popoolationte","indexing popoolationTE reference fasta", log=log)
         index_fasta(ref_fasta, log=log)
         mccutils.log("popoolationte","mapping fastq1 reads", log=log)
@@ -40,6 +53,9 @@ def main():
         bam = sam_to_bam(combined_sam, threads=threads, log=log)
         sorted_bam = sort_bam(bam, threads=threads, log=log)
         sorted_sam = bam_to_sam(sorted_bam, threads=threads, log=log)
+        mccutils.check_file_exists(sorted_sam)
+        if cache_dir != "None":
+            cache.store_alignments(cache_dir, key, [sorted_sam], max_size=snakemake.config['args']['cache_max_size'], log=log)
         
         with open(status_log,"w") as l:
             l.write("COMPLETED\n")
@@ -63,7 +79,7 @@ def format_read_names(fq1, fq2, sample_name, out_dir):
     outfq2 = out_dir+"reads2.fastq"
 
     with open(outfq1,"w") as outfq:
-        with open(fq1,"r") as infq:
+        with mccutils.open_file(fq1,"r") as infq:
             read_num = 1
             for l,line in enumerate(infq):
                 if l%4 == 0:
@@ -73,7 +89,7 @@ def format_read_names(fq1, fq2, sample_name, out_dir):
                     outfq.write(line)
     
     with open(outfq2,"w") as outfq:
-        with open(fq2,"r") as infq:
+        with mccutils.open_file(fq2,"r") as infq:
             read_num = 1
             for l,line in enumerate(infq):
                 if l%4 == 0:
@@ -86,7 +102,7 @@ def format_read_names(fq1, fq2, sample_name, out_dir):
 
 def index_fasta(fasta, log=None):
     command = ["bwa", "index", fasta]
-    mccutils.run_command(command, log=log)
+    cache.get_index(snakemake.config['args']['cache'], fasta, "bwa", cache.get_index_files("bwa", fasta), [command], log=log)
 
 def map_reads(fq, fasta, threads=1, log=None):
     outfile = fq.split(".")
@@ -94,7 +110,8 @@ def map_reads(fq, fasta, threads=1, log=None):
     outfile = ".".join(outfile)
 
     command = ["bwa", "bwasw", "-t", str(threads), fasta, fq]
-    mccutils.run_command_stdout(command, outfile, log=log)
+    if not mccutils.run_command_stdout(command, outfile, log=log):
+        raise subprocess.CalledProcessError(1, command)
 
     return outfile
 
@@ -102,7 +119,8 @@ def map_reads(fq, fasta, threads=1, log=None):
 def combine_alignments(sam1, sam2, fq1, fq2, script_path, out, log=None):
     out_sam = out+"combined.sam"
     command = ["perl", script_path+"samro.pl", "--sam1", sam1, "--sam2", sam2, "--fq1", fq1, "--fq2", fq2, "--output", out_sam]
-    mccutils.run_command(command, log=log)
+    if not mccutils.run_command(command, log=log):
+        raise subprocess.CalledProcessError(1, command)
     return out_sam
 
 
@@ -112,7 +130,8 @@ def sam_to_bam(sam, threads=1, log=None):
     bam = ".".join(bam)
 
     command = ["samtools","view", "-Sb", "-@", str(threads), sam]
-    mccutils.run_command_stdout(command, bam, log=log)
+    if not mccutils.run_command_stdout(command, bam, log=log):
+        raise subprocess.CalledProcessError(1, command)
 
     return bam
 
@@ -121,7 +140,8 @@ def sort_bam(bam, threads=1, log=None):
     sorted_bam[-1] = "sorted.bam"
     sorted_bam = ".".join(sorted_bam)
     command = ["samtools", "sort", bam, "-@", str(threads), "-o", sorted_bam]
-    mccutils.run_command_stdout(command, sorted_bam, log=log)
+    if not mccutils.run_command_stdout(command, sorted_bam, log=log):
+        raise subprocess.CalledProcessError(1, command)
 
     return sorted_bam
 
@@ -131,7 +151,8 @@ def bam_to_sam(bam, threads=1, log=None):
     sam = ".".join(sam)
 
     command = ["samtools", "view", "-@", str(threads), bam]
-    mccutils.run_command_stdout(command, sam, log=log)
+    if not mccutils.run_command_stdout(command, sam, log=log):
+        raise subprocess.CalledProcessError(1, command)
 
     return sam
 
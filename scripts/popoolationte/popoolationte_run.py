@@ -1,7 +1,6 @@
 import os
 import sys
 import subprocess
-import statistics
 import traceback
 import importlib.util as il
 spec = il.spec_from_file_location("config", snakemake.params.config)
@@ -102,17 +101,11 @@ def get_read_length(fq1, fq2):
     return int(read_length)
 
 def get_median_insert_size(sam):
-    insert_sizes = []
-    with open(sam,"r") as s:
-        for line in s:
-            split_line = line.split("\t")
-            if len(split_line) >= 8:
-                insert_size = int(split_line[8])
-                if insert_size > 0:
-                    insert_sizes.append(insert_size)
-    
-    insert_sizes.sort()
-    median = statistics.median(insert_sizes)
+    # PoPoolationTE maps the reads to its own reference, so the insert size is estimated from its SAM
+    max_pairs = None
+    if snakemake.config['args']['insert_size_pairs'] != "None":
+        max_pairs = int(snakemake.config['args']['insert_size_pairs'])
+    median = mccutils.calc_median_insert_size(sam, max_pairs=max_pairs)
 
     return int(median)
 
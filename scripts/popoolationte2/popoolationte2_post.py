@@ -20,7 +20,7 @@ def main():
 
     out_dir = snakemake.params.out_dir
     sample_name = snakemake.params.sample_name
-    chromosomes = snakemake.params.chromosomes.split(",")
+    chromosomes = mccutils.get_chromosomes(snakemake.params.chromosomes)
     log = snakemake.params.log
 
     status_log = snakemake.params.status_log
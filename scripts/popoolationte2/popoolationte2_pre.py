@@ -4,6 +4,7 @@ import subprocess
 import traceback
 sys.path.append(snakemake.config['args']['mcc_path'])
 import scripts.mccutils as mccutils
+import scripts.cache as cache
 
 
 
@@ -24,6 +25,16 @@ def main():
         for f in os.listdir(out_dir):
             mccutils.remove(out_dir+"/"+f)
 
+        cache_dir = snakemake.config['args']['cache']
+        if cache_dir != "None":
+            key = cache.get_alignment_key(ref_fasta, [fq1, fq2], ["bwa", "bwasw", "se2pe", "--sort"], env=snakemake.config['envs']['popoolationte2'])
+
+        if cache_dir != "None" and cache.restore_alignments(cache_dir, key, [snakemake.output.bam], log=log):
+            with open(status_log,"w") as l:
+                l.write("COMPLETED\n")
+            mccutils.log("popoolationte2","PopoolationTE2 preprocessing complete")
+            return
+
         mccutils.mkdir(out_dir+"/tmp")
         index_fasta(ref_fasta, log=log)
         fq1 = format_fastq(fq1, out_dir+"/reads_1.fastq", log=log)
@@ -34,6 +45,8 @@ def main():
         mccutils.remove(out_dir+"/tmp")
 
         mccutils.check_file_exists(snakemake.output.bam)
+        if cache_dir != "None":
+            cache.store_alignments(cache_dir, key, [snakemake.output.bam], max_size=snakemake.config['args']['cache_max_size'], log=log)
         with open(status_log,"w") as l:
             l.write("COMPLETED\n")
 
@@ -54,11 +67,11 @@ def main():
 def index_fasta(fasta, log=None):
     mccutils.log("popoolationte2","indexing reference fasta", log=log)
     command = ["bwa", "index", fasta]
-    mccutils.run_command(command, log=log)
+    cache.get_index(snakemake.config['args']['cache'], fasta, "bwa", cache.get_index_files("bwa", fasta), [command], log=log)
 
 def format_fastq(fq, out_fq, log=None):
     mccutils.log("popoolationte2","formatting fastq read names", log=log)
-    with open(fq,"r") as inf:
+    with mccutils.open_file(fq,"r") as inf:
         with open(out_fq,"w") as of:
             for ln,line in enumerate(inf, start=4):
                 if (ln%4) == 0:
@@ -72,18 +85,22 @@ def format_fastq(fq, out_fq, log=None):
 
 def map_reads(ref, fq, outsam, threads=1, log=None):
     mccutils.log("popoolationte2","mapping reads", log=log)
-    mccutils.run_command_stdout(["bwa","bwasw", "-t", str(threads), ref, fq], outsam, log=log)
+    command = ["bwa","bwasw", "-t", str(threads), ref, fq]
+    if not mccutils.run_command_stdout(command, outsam, log=log):
+        raise subprocess.CalledProcessError(1, command)
     return outsam
 
 def sam_to_bam(jar, fq1, fq2, sam1, sam2, bam, out_dir, threads=1, log=None):
     mccutils.log("popoolationte2","converting SAM to BAM", log=log)
-    mccutils.run_command(["java", "-Djava.io.tmpdir="+out_dir+"/tmp", "-jar",jar, "se2pe", 
+    command = ["java", "-Djava.io.tmpdir="+out_dir+"/tmp", "-jar",jar, "se2pe", 
                                               "--fastq1", fq1,
                                               "--fastq2", fq2,
                                               "--bam1", sam1,
                                               "--bam2", sam2,
                                               "--sort",
-                                              "--output", bam], log=log)
+                                              "--output", bam]
+    if not mccutils.run_command(command, log=log):
+        raise subprocess.CalledProcessError(1, command)
     return bam
 
 
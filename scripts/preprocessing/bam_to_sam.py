@@ -0,0 +1,36 @@
+import os
+import sys
+import subprocess
+import traceback
+try:
+    sys.path.append(snakemake.config['args']['mcc_path'])
+    import scripts.mccutils as mccutils
+except Exception as e:
+    track = traceback.format_exc()
+    print(track, file=sys.stderr)
+    print("ERROR...unable to locate required external scripts at: "+snakemake.config['args']['mcc_path']+"/scripts/", file=sys.stderr)
+    sys.exit(1)
+
+
+def main():
+    # the text SAM is only made for the methods that need it
+    log = snakemake.params.log
+    mccutils.log("processing","converting bam to sam", log=log)
+
+    try:
+        command = ["samtools", "view", "-h", "-@", str(snakemake.threads), "-o", snakemake.output[0]] + mccutils.reference_args(snakemake.input.bam, snakemake.input.ref) + [snakemake.input.bam]
+        mccutils.run_command(command, log=log)
+        mccutils.check_file_exists(snakemake.output[0])
+
+    except Exception as e:
+        track = traceback.format_exc()
+        print(track, file=sys.stderr)
+        print("ERROR...unable to convert bam to sam using SAMtools...bam file:", snakemake.input.bam, file=sys.stderr)
+        mccutils.remove(snakemake.output[0])
+        sys.exit(1)
+
+    mccutils.log("processing","bam converted to sam")
+
+
+if __name__ == "__main__":                
+    main()
@@ -0,0 +1,39 @@
+import os
+import sys
+import subprocess
+import traceback
+try:
+    sys.path.append(snakemake.config['args']['mcc_path'])
+    import scripts.mccutils as mccutils
+except Exception as e:
+    track = traceback.format_exc()
+    print(track, file=sys.stderr)
+    print("ERROR...unable to locate required external scripts at: "+snakemake.config['args']['mcc_path']+"/scripts/", file=sys.stderr)
+    sys.exit(1)
+
+
+def main():
+    # temporary BAM for the methods that can't read CRAM, removed once they have finished
+    log = snakemake.params.log
+    mccutils.log("processing","decoding cram to bam", log=log)
+
+    try:
+        command = ["samtools", "view", "-b", "-@", str(snakemake.threads), "--reference", snakemake.input.ref, "-o", snakemake.output.bam, snakemake.input.cram]
+        mccutils.run_command(command, log=log)
+        mccutils.check_file_exists(snakemake.output.bam)
+        mccutils.run_command(["samtools", "index", "-@", str(snakemake.threads), snakemake.output.bam], log=log)
+        mccutils.check_file_exists(snakemake.output.bai)
+
+    except Exception as e:
+        track = traceback.format_exc()
+        print(track, file=sys.stderr)
+        print("ERROR...unable to decode cram to bam using SAMtools...cram file:", snakemake.input.cram, file=sys.stderr)
+        mccutils.remove(snakemake.output.bam)
+        mccutils.remove(snakemake.output.bai)
+        sys.exit(1)
+
+    mccutils.log("processing","cram decoded to bam")
+
+
+if __name__ == "__main__":
+    main()
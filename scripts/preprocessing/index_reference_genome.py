@@ -5,6 +5,7 @@ import traceback
 try:
     sys.path.append(snakemake.config['args']['mcc_path'])
     import scripts.mccutils as mccutils
+    import scripts.cache as cache
 except Exception as e:
     track = traceback.format_exc()
     print(track, file=sys.stderr)
@@ -16,8 +17,10 @@ def main():
     try:
         log = snakemake.params.log
         mccutils.log("processing","making samtools and bwa index files for reference fasta", log=log)
-        mccutils.run_command(["samtools", "faidx", snakemake.input.ref],log=log)
-        mccutils.run_command(["bwa", "index", snakemake.input.ref], log=log)
+        ref = snakemake.input.ref
+        cache_dir = snakemake.config['args']['cache']
+        cache.get_index(cache_dir, ref, "faidx", cache.get_index_files("faidx", ref), [["samtools", "faidx", ref]], log=log)
+        cache.get_index(cache_dir, ref, "bwa", cache.get_index_files("bwa", ref), [["bwa", "index", ref]], log=log)
 
         for out in snakemake.output:
             mccutils.check_file_exists(out)
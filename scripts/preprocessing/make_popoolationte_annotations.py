@@ -22,7 +22,7 @@ def main():
     run_id = snakemake.params.run_id
     log = snakemake.params.log
     augment = snakemake.params.augment
-    chromosomes = snakemake.params.chromosomes.split(",")
+    chromosomes = mccutils.get_chromosomes(snakemake.params.chromosomes)
     popoolationte_taxonomy = snakemake.output.taxonomy
     popoolationte_te_gff = snakemake.output.te_gff
 
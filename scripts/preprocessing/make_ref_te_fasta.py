@@ -21,7 +21,7 @@ def main():
     run_id = snakemake.params.run_id
     log = snakemake.params.log
     augment = snakemake.params.augment
-    chromosomes = snakemake.params.chromosomes.split(",")
+    chromosomes = mccutils.get_chromosomes(snakemake.params.chromosomes)
     ref_te_fasta = snakemake.output.ref_te_fasta
 
     mccutils.log("processing", "making reference TE fasta", log=log)
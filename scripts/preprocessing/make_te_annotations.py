@@ -7,6 +7,7 @@ try:
     sys.path.append(snakemake.config['args']['mcc_path'])
     import scripts.mccutils as mccutils
     import scripts.fix_fasta as fix_fasta
+    import scripts.repeatmasker as repeatmasker
 except Exception as e:
     track = traceback.format_exc()
     print(track, file=sys.stderr)
@@ -22,7 +23,7 @@ def main():
     mcc_out = snakemake.params.mcc_out
     run_id = snakemake.params.run_id
     log = snakemake.params.log
-    chromosomes = snakemake.params.chromosomes.split(",")
+    chromosomes = mccutils.get_chromosomes(snakemake.params.chromosomes)
     augment = snakemake.params.augment
     processors = snakemake.threads
     out_te_gff = snakemake.output.te_gff
@@ -62,16 +63,10 @@ def main():
 def repeat_mask(reference, te_fasta, chromosomes, procs, run_id, log, out):
     try:
         outdir = out+"/tmp/repeatmasker_"+run_id
-        mccutils.mkdir(outdir)
-        os.chdir(outdir)
-        command = ["RepeatMasker","-pa", str(procs), "-lib", te_fasta, "-dir", outdir, "-s", "-gff", "-nolow", "-no_is", reference]
-        mccutils.run_command(command, log=log)
-        os.chdir(out)
+        repeatmasker_out, repeatmasker_gff, masked_fasta = repeatmasker.repeatmask(reference, te_fasta, procs, outdir, snakemake.config['args']['cache'], out, max_size=snakemake.config['args']['cache_max_size'], log=log)
 
         # RepeatMasker appears to override the custom database names during the ProcessRepeats
         # this step changes them back, more rules may be needed for other reference genomes
-        ref_name = os.path.basename(reference)
-        repeatmasker_gff = outdir+"/"+ref_name+".out.gff"
         formatted_ref_tes = out+"/tmp/"+run_id+"tmpreferenceTEs.gff"
         with open(repeatmasker_gff,"r") as rmgff:
             with open(formatted_ref_tes,"w") as outgff:
@@ -92,7 +87,6 @@ def repeat_mask(reference, te_fasta, chromosomes, procs, run_id, log, out):
                             outgff.write(line+'\n')
 
 
-        masked_fasta = outdir+"/"+ref_name+".masked"
         fasta_lines = fix_fasta.fix_fasta_lines(masked_fasta, 80)
 
         mccutils.check_file_exists(formatted_ref_tes)
@@ -13,7 +13,8 @@ except Exception as e:
 
 
 def main():
-    mccutils.log("processing","mapping reads to reference", log=snakemake.log[0])
+    log = snakemake.params.log
+    mccutils.log("processing","mapping reads to reference", log=log)
 
     try:
         command = ["bwa","mem"]
@@ -24,10 +25,9 @@ def main():
 
         if snakemake.config['in']['fq2'] != "None":
             command.append(snakemake.input.fq2)
-        
-        mccutils.run_command_stdout(command, snakemake.output[0], log=snakemake.log[0])
-        
-        mccutils.check_file_exists(snakemake.output[0])
+
+        map_reads(command, snakemake.params.markdup, snakemake.input.ref, snakemake.output.bam, snakemake.output.metrics, snakemake.params.tmp_prefix, threads=snakemake.threads, mem_mb=snakemake.resources.mem_mb, log=snakemake.log[0])
+        mccutils.check_file_exists(snakemake.output.bam)
     
     except Exception as e:
         track = traceback.format_exc()
@@ -36,10 +36,99 @@ def main():
             print("ERROR...unable to map reads (bwa mem) using reference fasta:",snakemake.input.ref,"and reads:", snakemake.input.fq1, file=sys.stderr)
         else:
             print("ERROR...unable to map reads (bwa mem) using reference fasta:",snakemake.input.ref,"and reads:", snakemake.input.fq1, snakemake.input.fq2, file=sys.stderr)
+        mccutils.remove(snakemake.output.bam)
         sys.exit(1)
-        
+
     mccutils.log("processing","read mapping complete")
 
+    try:
+        command = ["samtools", "index", "-@", str(snakemake.threads), snakemake.output.bam]
+        mccutils.run_command(command, log=log)
+        if is_cram(snakemake.output.bam):
+            mccutils.check_file_exists(snakemake.output.bam+".crai")
+        else:
+            mccutils.check_file_exists(snakemake.output.bam+".bai")
+
+    except Exception as e:
+        track = traceback.format_exc()
+        print(track, file=sys.stderr)
+        print("ERROR...falied to index the bam file using samtools index...bam file:", snakemake.output.bam, file=sys.stderr)
+        sys.exit(1)
+
+    try:
+        command = ["samtools", "flagstat", "-@", str(snakemake.threads), snakemake.output.bam]
+        if is_cram(snakemake.output.bam):
+            # flagstat can't be given the reference to decode the CRAM
+            commands = [
+                ["samtools", "view", "-u", "--reference", snakemake.input.ref, snakemake.output.bam],
+                command[:-1] + ["-"]
+            ]
+            run_pipeline(commands, out_file=snakemake.output.flagstat, log=log)
+        elif not mccutils.run_command_stdout(command, snakemake.output.flagstat, log=log):
+            raise subprocess.CalledProcessError(1, command)
+        mccutils.check_file_exists(snakemake.output.flagstat)
+    
+    except Exception as e:
+        track = traceback.format_exc()
+        print(track, file=sys.stderr)
+        print("ERROR...falied to generate flagstat file using samtools flagstat...bam file:", snakemake.output.bam, file=sys.stderr)
+        sys.exit(1)
+
+
+def is_cram(alignments):
+    return alignments.split(".")[-1] == "cram"
+
+
+def map_reads(bwa_command, markdup, ref, out_bam, metrics, tmp_prefix, threads=1, mem_mb=1000, log=None):
+    # the alignments are streamed from bwa mem to samtools sort, only the sorted BAM (and for picard, the final BAM) are written
+    # each sort thread gets an equal share of half of the rule's memory, the rest is left to bwa
+    sort_mem = max(100, mem_mb//(2*threads))
+    sort_command = ["samtools", "sort", "-@", str(threads), "-m", str(sort_mem)+"M", "-T", tmp_prefix]
+
+    # --cram: the final alignments are encoded against the reference, using the same threads
+    out_format = []
+    if is_cram(out_bam):
+        out_format = ["-O", "cram", "--reference", ref]
+
+    if markdup == "samtools":
+        # bwa mem | samtools fixmate | samtools sort | samtools markdup
+        commands = [
+            bwa_command,
+            ["samtools", "fixmate", "-m", "-O", "bam,level=0", "-", "-"],
+            sort_command + ["-O", "bam,level=0", "-"],
+            ["samtools", "markdup", "-@", str(threads), "-s", "-f", metrics] + out_format + ["-", out_bam]
+        ]
+        run_pipeline(commands, log=log)
+
+    elif markdup == "picard":
+        sorted_bam = tmp_prefix+".bam"
+        try:
+            run_pipeline([bwa_command, sort_command + ["-o", sorted_bam, "-"]], log=log)
+            marked_bam = out_bam
+            if is_cram(out_bam):
+                marked_bam = tmp_prefix+".markdup.bam"
+            command = ['picard', "MarkDuplicates", "-I", sorted_bam, "-O", marked_bam, "-M", metrics]
+            if not mccutils.run_command(command, log=log):
+                raise subprocess.CalledProcessError(1, command)
+
+            if is_cram(out_bam):
+                command = ["samtools", "view", "-@", str(threads), "-o", out_bam] + out_format + [marked_bam]
+                if not mccutils.run_command(command, log=log):
+                    raise subprocess.CalledProcessError(1, command)
+        finally:
+            mccutils.remove(sorted_bam)
+            mccutils.remove(tmp_prefix+".markdup.bam")
+
+    else:
+        run_pipeline([bwa_command, sort_command + ["-o", out_bam] + out_format + ["-"]], log=log)
+        with open(metrics, "w") as out:
+            out.write("duplicate marking skipped (--markdup none)\n")
+
+
+def run_pipeline(commands, out_file=None, log=None):
+    if not mccutils.run_pipeline(commands, out_file=out_file, log=log):
+        raise subprocess.CalledProcessError(1, " | ".join([" ".join(command) for command in commands]))
+
 
 if __name__ == "__main__":                
-    main()
\ No newline at end of file
+    main()
@@ -21,7 +21,7 @@ def main():
     run_id = snakemake.params.run_id
     log = snakemake.params.log
     augment = snakemake.params.augment
-    chromosomes = snakemake.params.chromosomes.split(",")
+    chromosomes = mccutils.get_chromosomes(snakemake.params.chromosomes)
     masked_ref = snakemake.output.masked_ref
 
     mccutils.log("processing","masking reference fasta", log=log)
@@ -3,26 +3,52 @@ import sys
 import subprocess
 sys.path.append(snakemake.config['args']['mcc_path'])
 import scripts.mccutils as mccutils
-import statistics
 
 
 def main():
     fq2 = snakemake.params.fq2
+    log = snakemake.params.log
 
     if fq2 != "None":
         mccutils.log("processing","calculating median insert size of reads")
-        median = mccutils.calc_median_insert_size(snakemake.input[0])
+        max_pairs = None
+        if snakemake.params.max_pairs != "None":
+            max_pairs = int(snakemake.params.max_pairs)
 
-        if median > 0:
-            with open(snakemake.output[0],"w") as out:
-                out.write("median_insert_size="+str(median)+"\n")
-                
+        metrics = get_insert_size_metrics(snakemake.input.bam, snakemake.input.ref, max_pairs=max_pairs, log=log)
+
+        if metrics["median_insert_size"] > 0:
+            mccutils.write_insert_size_metrics(metrics, snakemake.output[0])
             mccutils.log("processing","median insert size of reads calculated")
     
     else:
-        with open(snakemake.output[0],"w") as out:
-            out.write("median_insert_size=0\n")
+        mccutils.write_insert_size_metrics({"median_insert_size": 0}, snakemake.output[0])
+
+
+def get_insert_size_metrics(bam, ref, max_pairs=None, log=None):
+    # streams the primary, non-duplicate alignments of proper pairs from the BAM
+    command = ["samtools", "view", "-f", "2", "-F", "3852"] + mccutils.reference_args(bam, ref) + [bam]
+    with open(log, "a") as err:
+        err.write(" ".join(command)+"\n")
+        proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=err, universal_newlines=True, bufsize=1048576)
+        try:
+            histogram = mccutils.insert_size_histogram(proc.stdout, max_pairs=max_pairs)
+        except Exception:
+            proc.kill()
+            raise
+
+        sampled = max_pairs is not None and sum(histogram.values()) >= max_pairs
+        if sampled:
+            # stops reading once enough pairs are sampled
+            proc.kill()
+        proc.stdout.close()
+        returncode = proc.wait()
+
+    if returncode != 0 and not sampled:
+        raise subprocess.CalledProcessError(returncode, command)
+
+    return mccutils.calc_insert_size_metrics(histogram)
         
 
 if __name__ == "__main__":                
-    main()
\ No newline at end of file
+    main()
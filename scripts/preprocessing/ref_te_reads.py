@@ -0,0 +1,19 @@
+import os
+import sys
+import subprocess
+sys.path.append(snakemake.config['args']['mcc_path'])
+import scripts.mccutils as mccutils
+
+
+def main():
+    log = snakemake.params.log
+    mccutils.log("processing","extracting reads that map to reference TEs", log=log)
+    # a single pass over the sorted BAM, so the output stays sorted
+    command = ["samtools", "view", "-b", "-L", snakemake.input.ref_te_bed, "-o", snakemake.output[0]] + mccutils.reference_args(snakemake.input.bam, snakemake.input.ref) + [snakemake.input.bam]
+    mccutils.run_command(command, log=log, fatal=True)
+    mccutils.check_file_exists(snakemake.output[0])
+    mccutils.log("processing","reference TE reads extracted")
+
+
+if __name__ == "__main__":
+    main()
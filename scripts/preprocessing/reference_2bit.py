@@ -3,13 +3,14 @@ import sys
 import subprocess
 sys.path.append(snakemake.config['args']['mcc_path'])
 import scripts.mccutils as mccutils
+import scripts.cache as cache
 
 
 def main():
     log = snakemake.params.log
     mccutils.log("processing","creating 2bit file from reference genome fasta",log=log)
     command = ["faToTwoBit", snakemake.input[0], snakemake.output[0]]
-    mccutils.run_command(command, log=log)
+    cache.get_index(snakemake.config['args']['cache'], snakemake.input[0], "2bit", [snakemake.output[0]], [command], log=log)
     mccutils.log("processing","reference 2bit file created")
         
 
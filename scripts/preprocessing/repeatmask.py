@@ -5,6 +5,7 @@ import sys
 import subprocess
 sys.path.append(snakemake.config['args']['mcc_path'])
 import scripts.mccutils as mccutils
+import scripts.repeatmasker as repeatmasker
 
 def main():
     reference = snakemake.input.reference
@@ -29,19 +30,10 @@ def run_repeatmasker(reference, ref_name, te_seqs, threads, log, outfile, outdir
     tmp_dir = outdir+"/tmp/repeatmasker"
     mccutils.remove(tmp_dir)
     mccutils.mkdir(tmp_dir)
-    os.chdir(tmp_dir)
 
-    command = ["RepeatMasker","-pa", str(threads), "-lib", te_seqs, "-dir", tmp_dir, "-s", "-nolow", "-no_is", reference]
-    mccutils.run_command(command, log=log)
+    rm_out, rm_gff, rm_masked = repeatmasker.repeatmask(reference, te_seqs, threads, tmp_dir, snakemake.config['args']['cache'], outdir, max_size=snakemake.config['args']['cache_max_size'], log=log)
 
-    os.chdir(outdir)
-
-    rm_out = ""
-    for f in os.listdir(tmp_dir):
-        if "fasta.out" in f and f[-9:] == "fasta.out":
-            rm_out = tmp_dir+"/"+f
-
-    if rm_out == "":
+    if not os.path.exists(rm_out):
         sys.exit("can't find Repeatmasker output in:"+tmp_dir+"\n")
 
     mccutils.run_command(["mv", rm_out, outfile])
@@ -0,0 +1,73 @@
+import os
+import sys
+import subprocess
+sys.path.append(snakemake.config['args']['mcc_path'])
+import scripts.mccutils as mccutils
+
+# above this many chromosomes a shard is extracted with a BED file instead of region arguments
+MAX_REGION_ARGS = 1000
+
+def main():
+    log = snakemake.params.log
+    shard = snakemake.wildcards.shard
+    chromosomes = mccutils.get_chromosomes(snakemake.params.shard)
+    out_dir = os.path.dirname(snakemake.output.bam)+"/"
+    mccutils.log("processing","creating BAM for shard: "+shard+" ("+str(len(chromosomes))+" chromosomes)", log=log)
+
+    region_bam = extract_regions(snakemake.input.bam, snakemake.input.ref, chromosomes, out_dir, log)
+
+    # reads on reference TEs elsewhere in the genome are kept so that discordant mates landing in TEs are not lost
+    te_bam = extract_other_te_reads(snakemake.input.ref_te_reads, snakemake.input.ref_te_bed, chromosomes, out_dir, log)
+
+    if te_bam is not None:
+        command = ["samtools", "merge", "-f", snakemake.output.bam, region_bam, te_bam]
+        mccutils.run_command(command, log=log, fatal=True)
+        mccutils.remove(region_bam)
+        mccutils.remove(te_bam)
+    else:
+        os.replace(region_bam, snakemake.output.bam)
+
+    mccutils.run_command(["samtools", "index", snakemake.output.bam], log=log, fatal=True)
+    mccutils.check_file_exists(snakemake.output.bai)
+    mccutils.log("processing","BAM for shard: "+shard+" created", log=log)
+
+
+def extract_regions(bam, ref, chromosomes, out, log):
+    region_bam = out+"regions.tmp.bam"
+    if len(chromosomes) <= MAX_REGION_ARGS:
+        # uses the BAM index to read only these chromosomes
+        command = ["samtools", "view", "-b", "-o", region_bam] + mccutils.reference_args(bam, ref) + [bam] + list(chromosomes.keys())
+    else:
+        region_bed = out+"regions.tmp.bed"
+        with open(region_bed, "w") as outbed:
+            for chrom, length in chromosomes.items():
+                outbed.write(chrom+"\t0\t"+str(length)+"\n")
+        command = ["samtools", "view", "-b", "-L", region_bed, "-o", region_bam] + mccutils.reference_args(bam, ref) + [bam]
+
+    mccutils.run_command(command, log=log, fatal=True)
+    return region_bam
+
+
+def extract_other_te_reads(te_reads_bam, ref_te_bed, chromosomes, out, log):
+    other_te_bed = out+"other_TEs.tmp.bed"
+    other_tes = 0
+    with open(ref_te_bed, "r") as inbed, open(other_te_bed, "w") as outbed:
+        for line in inbed:
+            if line.split("\t")[0] not in chromosomes:
+                outbed.write(line)
+                other_tes += 1
+
+    if other_tes < 1:
+        mccutils.remove(other_te_bed)
+        return None
+
+    te_bam = out+"other_TEs.tmp.bam"
+    command = ["samtools", "view", "-b", "-L", other_te_bed, "-o", te_bam, te_reads_bam]
+    mccutils.run_command(command, log=log, fatal=True)
+    mccutils.remove(other_te_bed)
+
+    return te_bam
+
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,9 @@ import os
 import sys
 import subprocess
 import traceback
+import shutil
+import itertools
+import zlib
 from datetime import datetime
 try:
     import importlib
@@ -13,7 +16,6 @@ try:
     spec.loader.exec_module(trimgalore)
     sys.path.append(snakemake.config['args']['mcc_path'])
     import scripts.mccutils as mccutils
-    from Bio import SeqIO
 except Exception as e:
     track = traceback.format_exc()
     print(track, file=sys.stderr)
@@ -33,6 +35,8 @@ def main():
     processors = snakemake.threads
     mcc_out = snakemake.params.out
     run_id = snakemake.params.run_id
+    compress = snakemake.params.compress == "True"
+    max_coverage = snakemake.params.max_coverage
     log = snakemake.params.log
 
     # now = datetime.now()
@@ -43,26 +47,26 @@ def main():
     trimmedfq2 = fq2
 
     try:
-        check_fastqs(fq1, fq2, mcc_out, min_length=30, log=log)
+        keep_fraction = None
+        if max_coverage != "None":
+            genome_length = sum(mccutils.get_chromosomes(snakemake.params.chromosomes).values())
+            keep_fraction = get_keep_fraction([fq for fq in [fq1, fq2] if fq != "None"], genome_length, float(max_coverage), log=log)
 
-        if "trimgalore" in methods:
+        if "trimgalore" not in methods:
+            # validates the reads while making the intermediate copies
+            setup_fastqs(fq1, fq2, snakemake.output[0], snakemake.output[1], min_length=30, compress=compress, keep_fraction=keep_fraction, threads=processors, log=log)
+
+        else:
+            setup_fastqs(fq1, fq2, None, None, min_length=30, threads=processors, log=log)
             mccutils.log("processing", "running trim_galore", log=log)
             if fq2 == "None":
-                trimmedfq = run_trim_galore(fq1, run_id, log, mcc_out, cores=processors, params=trimgalore.PARAMS["single_end"])
+                trimmedfq = run_trim_galore(fq1, run_id, log, mcc_out, cores=processors, compress=compress, params=trimgalore.PARAMS["single_end"])
             else:
-                trimmedfq, trimmedfq2 = run_trim_galore(fq1, run_id, log, mcc_out, fq2=fq2, cores=processors, params=trimgalore.PARAMS["paired_end"])
-            
-            run_multiqc(mcc_out+"/results/trimgalore/")
-            
-        
-        # make unzipped copies in mcc input dir        
-        make_copies(trimmedfq, trimmedfq2, snakemake.output[0], snakemake.output[1])
-    
-        # removes trimmed read files from trimgalore directory
-        if trimmedfq != fq1:
-            mccutils.remove(trimmedfq)
-        if trimmedfq2 != fq2:
-            mccutils.remove(trimmedfq2)
+                trimmedfq, trimmedfq2 = run_trim_galore(fq1, run_id, log, mcc_out, fq2=fq2, cores=processors, compress=compress, params=trimgalore.PARAMS["paired_end"])
+
+            # trim_galore writes the format of the intermediate reads, so the trimmed reads are renamed into place
+            # the MultiQC report is made by the trimgalore_multiqc rule while the reads are mapped
+            setup_fastqs(trimmedfq, trimmedfq2, snakemake.output[0], snakemake.output[1], validate=False, move=True, compress=compress, keep_fraction=keep_fraction, threads=processors, log=log)
 
     except Exception as e:
         track = traceback.format_exc()
@@ -81,64 +85,210 @@ def main():
     mccutils.log("processing", "read setup complete")
 
 
-def make_copies(fq1, fq2, fq1copy, fq2copy):
-    if "gz" in fq1.split(".")[-1]:
-        mccutils.run_command_stdout(["zcat",fq1], fq1copy)
-    else:
-        mccutils.run_command(["cp", fq1, fq1copy])
-    
-    if fq2 == "None":
-        mccutils.run_command(["touch", fq2copy])
-    
-    elif "gz" in fq2.split(".")[-1]:
-        mccutils.run_command_stdout(["zcat",fq2], fq2copy)
-    
-    else:
-        mccutils.run_command(["cp", fq2, fq2copy])
-    
-    return fq1copy, fq2copy
+def open_fastq(fq, threads=1):
+    if fq.split(".")[-1] == "gz":
+        if shutil.which("pigz") is not None:
+            command = ["pigz", "-dc", "-p", str(threads), fq]
+        else:
+            command = ["gzip", "-dc", fq]
+        proc = subprocess.Popen(command, stdout=subprocess.PIPE, bufsize=1048576)
+        return proc.stdout, proc
 
-def has_valid_read_lengths(fq1, fq2, min_length=30, paired=False):
-    if paired:
-        fqs_to_check = [fq1, fq2]
-    else:
-        fqs_to_check = [fq1]
-    
-    for x,fq in enumerate(fqs_to_check):
-        has_valid_reads = False
-        for record in SeqIO.parse(fq, "fastq"):
-            if len(str(record.seq)) >= min_length:
-                has_valid_reads = True
-                break
-        
-        if not has_valid_reads:
-            raise fileFormatError("fastq "+str(x+1)+" lacks any reads >= the minimum length of:"+str(min_length))
+    return open(fq, "rb", buffering=1048576), None
 
-def has_valid_read_ids(fq1, fq2, log=None):
-    passed = mccutils.run_command(["fastq_info", fq1, fq2], log=log, fatal=False)
-    if not passed:
-        raise fileFormatError("Paired fastq files failed validation, see: "+log+" for details")
 
+def wait_fastq(proc, fq):
+    if proc is not None and proc.wait() != 0:
+        raise fileFormatError("unable to decompress: "+fq)
 
 
-def check_fastqs(fq1, fq2, out, min_length=30, log=None):
-    mccutils.mkdir(out+"/tmp")
-    if fq2 == "None":
-        paired = False
-    else:
-        paired =True
-    
-    fq1, fq2 = make_copies(fq1, fq2, out+"/tmp/tmp_val_fq_1.fq", out+"/tmp/tmp_val_fq_2.fq")
+def write_fastq(out, compress=False, threads=1):
+    # compressed copies are written as BGZF by bgzip, which compresses in parallel
+    if compress:
+        with open(out, "wb") as outf:
+            proc = subprocess.Popen(["bgzip", "-@", str(threads), "-c"], stdin=subprocess.PIPE, stdout=outf, bufsize=1048576)
+        return proc.stdin, proc
 
-    has_valid_read_lengths(fq1, fq2, min_length=min_length, paired=paired)
+    return open(out, "wb", buffering=1048576), None
 
-    if paired:
-        has_valid_read_ids(fq1, fq2, log=log)
 
+def wait_write(proc, out):
+    if proc is not None and proc.wait() != 0:
+        raise fileFormatError("unable to compress: "+out)
+
+
+def read_records(inf, fq):
+    while True:
+        header = inf.readline()
+        if not header:
+            return
+        seq = inf.readline()
+        plus = inf.readline()
+        qual = inf.readline()
+        if header[:1] != b"@" or plus[:1] != b"+" or len(seq.rstrip()) != len(qual.rstrip()):
+            raise fileFormatError("malformed fastq record: "+header.decode(errors="replace").rstrip()+" in: "+fq)
+
+        yield header, seq, plus, qual
+
+
+def read_name(header):
+    name = header.split()[0]
+    if name[-2:] in [b"/1", b"/2"]:
+        name = name[:-2]
+
+    return name
+
+
+def setup_fastqs(fq1, fq2, fq1_out, fq2_out, min_length=30, validate=True, move=False, compress=False, keep_fraction=None, threads=1, log=None):
+    # one pass over each input: checks read lengths and mate names, writes copies that are decompressed (or compressed if compress=True)
+    # inputs that are already in the requested format are linked (or moved) instead of copied
+    # keep_fraction: only this fraction of the reads (pairs) is written, selected by a hash of the read name so mates stay together
+    # fq1_out/fq2_out of None only validates the reads
+    fqs = [fq1]
+    outs = [fq1_out]
+    if fq2 != "None":
+        fqs.append(fq2)
+        outs.append(fq2_out)
+    elif fq2_out is not None:
+        mccutils.run_command(["touch", fq2_out])
+
+    compressed = [fq.split(".")[-1] == "gz" for fq in fqs]
+    needs_copy = [outs[x] is not None and (compressed[x] != compress or keep_fraction is not None) for x in range(len(fqs))]
+    if not validate and True not in needs_copy:
+        # reads that don't need to be checked or converted are moved or linked into place
+        for fq, out in zip(fqs, outs):
+            link_fastq(fq, out, move=move)
+        return
+
+    readers = []
+    writers = []
+    completed = False
+    try:
+        for x, fq in enumerate(fqs):
+            readers.append(open_fastq(fq, threads=threads))
+            if needs_copy[x]:
+                writers.append(write_fastq(outs[x], compress=compress, threads=threads))
+            else:
+                writers.append((None, None))
+
+        has_valid_reads = [False for fq in fqs]
+        records = [read_records(inf, fq) for (inf, proc), fq in zip(readers, fqs)]
+        read_num = 0
+        kept_reads = 0
+        if keep_fraction is not None:
+            keep_threshold = int(keep_fraction * 2**32)
+        for read_records_pair in itertools.zip_longest(*records):
+            read_num += 1
+            if None in read_records_pair:
+                raise fileFormatError("Paired fastq files have different numbers of reads, one file ends at read "+str(read_num))
 
-def run_trim_galore(fq1, run_id, log, out, fq2=None, cores=1, params={}):
+            keep = keep_fraction is None or zlib.crc32(read_name(read_records_pair[0][0])) < keep_threshold
+            if keep:
+                kept_reads += 1
+            for x, record in enumerate(read_records_pair):
+                if not has_valid_reads[x] and len(record[1].rstrip()) >= min_length:
+                    has_valid_reads[x] = True
+                if keep and writers[x][0] is not None:
+                    writers[x][0].writelines(record)
+
+            if validate and len(read_records_pair) > 1 and read_name(read_records_pair[0][0]) != read_name(read_records_pair[1][0]):
+                raise fileFormatError("Paired fastq files have mismatched read names at read "+str(read_num)+": "+read_records_pair[0][0].decode(errors="replace").rstrip()+" "+read_records_pair[1][0].decode(errors="replace").rstrip())
+
+        if validate:
+            for x, valid in enumerate(has_valid_reads):
+                if not valid:
+                    raise fileFormatError("fastq "+str(x+1)+" lacks any reads >= the minimum length of:"+str(min_length))
+
+        completed = True
+
+    finally:
+        for inf, proc in readers:
+            if proc is not None and not completed:
+                proc.kill()
+            inf.close()
+        for outf, proc in writers:
+            if outf is not None:
+                outf.close()
+            if proc is not None and not completed:
+                proc.kill()
+
+    for (inf, proc), fq in zip(readers, fqs):
+        wait_fastq(proc, fq)
+    for (outf, proc), out in zip(writers, outs):
+        wait_write(proc, out)
+
+    mccutils.log("processing", "processed "+str(read_num)+" reads", log=log)
+    if keep_fraction is not None and True in needs_copy:
+        mccutils.log("processing", "downsampled to "+str(kept_reads)+" reads", log=log)
+
+    for x, fq in enumerate(fqs):
+        if not needs_copy[x]:
+            if outs[x] is not None:
+                link_fastq(fq, outs[x], move=move)
+        elif move:
+            mccutils.remove(fq)
+
+
+def get_keep_fraction(fqs, genome_length, max_coverage, log=None):
+    # fraction of the reads to keep so the coverage of the genome is at most max_coverage, None if it is already below
+    bases = 0
+    for fq in fqs:
+        bases += estimate_bases(fq)
+
+    coverage = bases/genome_length
+    mccutils.log("processing", "estimated read coverage: "+str(round(coverage, 1))+"x", log=log)
+    if coverage <= max_coverage:
+        return None
+
+    mccutils.log("processing", "downsampling reads to "+str(max_coverage)+"x coverage", log=log)
+    return max_coverage/coverage
+
+
+def estimate_bases(fq, sample_size=8388608):
+    # extrapolates the bases per byte at the start of the file to the whole file, so the reads don't need an extra pass
+    size = os.path.getsize(fq)
+    with open(fq, "rb") as inf:
+        sample = inf.read(sample_size)
+
+    if len(sample) < 1:
+        return 0
+
+    data = sample
+    if fq.split(".")[-1] == "gz":
+        # decompresses every gzip member (e.g. BGZF blocks) in the sample, the last one is usually truncated
+        data = []
+        remaining = sample
+        while len(remaining) > 0:
+            decompressor = zlib.decompressobj(31)
+            data.append(decompressor.decompress(remaining))
+            if not decompressor.eof:
+                break
+            remaining = decompressor.unused_data
+        data = b"".join(data)
+
+    lines = data.split(b"\n")
+    sample_bases = 0
+    for x in range(1, len(lines)-3, 4):
+        sample_bases += len(lines[x].rstrip())
+
+    return int(sample_bases * (size/len(sample)))
+
+
+def link_fastq(fq, out, move=False):
+    mccutils.remove(out)
+    if move:
+        shutil.move(fq, out)
+    else:
+        os.symlink(os.path.abspath(fq), out)
+
+
+def run_trim_galore(fq1, run_id, log, out, fq2=None, cores=1, compress=False, params={}):
     mccutils.mkdir(out+"/results/")
     command = ['trim_galore', "-j", str(cores), "-o", out+"/results/trimgalore"]
+    if compress:
+        command.append("--gzip")
+    else:
+        command.append("--dont_gzip")
 
     for param in params.keys():
         if params[param] == True:
@@ -173,10 +323,5 @@ def run_trim_galore(fq1, run_id, log, out, fq2=None, cores=1, params={}):
         file_exists = mccutils.check_file_exists(outfq2)
         return outfq1, outfq2
 
-def run_multiqc(trimgalore_dir):
-    os.chdir(trimgalore_dir)
-    mccutils.run_command(["multiqc","."])
-
-
 if __name__ == "__main__":                
     main()
@@ -0,0 +1,34 @@
+import os
+import sys
+import subprocess
+import traceback
+try:
+    sys.path.append(snakemake.config['args']['mcc_path'])
+    import scripts.mccutils as mccutils
+except Exception as e:
+    track = traceback.format_exc()
+    print(track, file=sys.stderr)
+    print("ERROR...unable to locate required external scripts at: "+snakemake.config['args']['mcc_path']+"/scripts/", file=sys.stderr)
+    sys.exit(1)
+
+
+def main():
+    trimgalore_dir = snakemake.params.trimgalore_dir
+    log = snakemake.params.log
+    mccutils.log("processing","making MultiQC report of trim_galore results", log=log)
+
+    try:
+        mccutils.run_command(["multiqc", "-f", "-o", trimgalore_dir, trimgalore_dir], log=log)
+        mccutils.check_file_exists(snakemake.output[0])
+
+    except Exception as e:
+        track = traceback.format_exc()
+        print(track, file=sys.stderr)
+        print("ERROR...unable to make MultiQC report of trim_galore results in:", trimgalore_dir, file=sys.stderr)
+        sys.exit(1)
+
+    mccutils.log("processing","MultiQC report complete")
+
+
+if __name__ == "__main__":
+    main()
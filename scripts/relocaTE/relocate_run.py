@@ -56,11 +56,12 @@ def main():
         os.symlink(snakemake.input.consensus_fasta, consensus_fasta)
         os.symlink(snakemake.input.te_gff, te_gff)
         os.symlink(snakemake.input.reference_fasta, reference_fasta)
+        # RelocaTE only reads plain text fastq, reads kept compressed are decompressed here
         if is_paired:
-            os.symlink(snakemake.input.fq1, fq_dir+sample_name+"."+fq1_uniq_id+".fq")
-            os.symlink(snakemake.input.fq2, fq_dir+sample_name+"."+fq2_uniq_id+".fq")
+            mccutils.plain_fastq(snakemake.input.fq1, fq_dir+sample_name+"."+fq1_uniq_id+".fq", threads=snakemake.threads, log=log)
+            mccutils.plain_fastq(snakemake.input.fq2, fq_dir+sample_name+"."+fq2_uniq_id+".fq", threads=snakemake.threads, log=log)
         else:
-            os.symlink(snakemake.input.fq1, fq_dir+sample_name+"."+unpaired_id+".fq")
+            mccutils.plain_fastq(snakemake.input.fq1, fq_dir+sample_name+"."+unpaired_id+".fq", threads=snakemake.threads, log=log)
 
 
 
@@ -86,6 +87,9 @@ def main():
         
         
         mccutils.run_command(command, log=log)
+        if snakemake.input.fq1.split(".")[-1] == "gz":
+            # removes the decompressed copies of the reads
+            mccutils.remove(fq_dir)
         combine_gffs(out_dir, out_gff)
                 
         mccutils.check_file_exists(out_gff)
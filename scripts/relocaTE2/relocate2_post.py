@@ -21,7 +21,7 @@ def main():
     log = snakemake.params.log
     out_dir = snakemake.params.out_dir
     sample_name = snakemake.params.sample_name
-    chromosomes = snakemake.params.chromosomes.split(",")
+    chromosomes = mccutils.get_chromosomes(snakemake.params.chromosomes)
     status_log = snakemake.params.status_log
     vcf_options = snakemake.params.vcf.split(",")
     
@@ -44,18 +44,23 @@ def main():
         os.symlink(snakemake.input.te_seqs, te_seqs)
         os.symlink(snakemake.input.rm_out, rm_out)
 
+        # RelocaTE2 reads gzipped fastq, the links keep the .gz extension of compressed reads
+        fq_ext = ".fq"
+        if snakemake.input.fq1.split(".")[-1] == "gz":
+            fq_ext = ".fq.gz"
+
         if is_paired:
-            fq1 = fq_dir+sample_name+"_1.fq"
-            fq2 = fq_dir+sample_name+"_2.fq"
+            fq1 = fq_dir+sample_name+"_1"+fq_ext
+            fq2 = fq_dir+sample_name+"_2"+fq_ext
             os.symlink(snakemake.input.fq1, fq1)
             os.symlink(snakemake.input.fq2, fq2)
         else:
-            fq1 = fq_dir+sample_name+".unPaired.fq"
+            fq1 = fq_dir+sample_name+".unPaired"+fq_ext
             os.symlink(snakemake.input.fq1, fq1)
 
 
 
-        median_insert_size = get_median_insert_size(median_insert_size_file)
+        median_insert_size = mccutils.get_median_insert_size(median_insert_size_file)
         # output = subprocess.Popen(["which", "relocaTE2.py"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         # script = output.stdout.read()
         # script = script.decode()
@@ -109,15 +114,5 @@ def main():
         mccutils.run_command(["touch", snakemake.output[0]])
         mccutils.run_command(["touch", snakemake.output[1]])
 
-def get_median_insert_size(infile):
-    median_insert_size = 0
-    with open(infile,"r") as inf:
-        for line in inf:
-            insert = line.split("=")[1]
-            insert = insert.replace("\n","")
-            median_insert_size = int(float(insert))
-    
-    return median_insert_size
-
 if __name__ == "__main__":                
     main()
\ No newline at end of file
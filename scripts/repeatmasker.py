@@ -0,0 +1,89 @@
+import os
+import sys
+import shutil
+import hashlib
+import subprocess
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import mccutils as mccutils
+import cache as cache
+
+REPEATMASKER_STORE = "repeatmasker"
+# store used when --cache is not set, kept apart from the out_dir of the callers
+RUN_STORE_DIR = "/tmp/repeatmasker_store"
+OPTIONS = ["-s", "-gff", "-nolow", "-no_is"]
+# outputs kept in the store, named after the genome fasta like RepeatMasker names them
+OUTPUT_SUFFIXES = [".out", ".out.gff", ".masked", ".tbl"]
+# outputs used by the callers, an entry is only published if all of them were made
+REQUIRED_SUFFIXES = [".out", ".out.gff", ".masked"]
+GENOME_NAME = "genome.fasta"
+
+def get_version():
+    try:
+        return subprocess.check_output(["RepeatMasker", "-v"], stderr=subprocess.STDOUT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def get_key(reference, lib):
+    key = hashlib.md5(cache.get_key([("reference", reference), ("lib", lib)], []).encode())
+    key.update((" ".join(OPTIONS)+"\n").encode())
+    key.update((get_version()+"\n").encode())
+    return key.hexdigest()
+
+def repeatmask(reference, lib, threads, out_dir, cache_dir, mcc_out, max_size=None, log=None):
+    # runs RepeatMasker once per genome, library, option set and version
+    # results are kept in the --cache directory if it is used, otherwise in the run's RUN_STORE_DIR
+    # the outputs are copied to out_dir named after the reference, as if RepeatMasker had been run there
+    if cache_dir is None or cache_dir == "None":
+        store_dir = mcc_out+RUN_STORE_DIR
+        max_size = None
+    else:
+        store_dir = cache_dir
+        max_size = cache.get_max_size(max_size)
+
+    key = get_key(reference, lib)
+    entry, lock_file = cache.get_entry(store_dir, REPEATMASKER_STORE, key)
+
+    # other consumers of the same genome and library wait here for the first run to finish
+    with cache.file_lock(lock_file):
+        # entries missing any of the required outputs are made again
+        if os.path.exists(entry) and not all([os.path.exists(entry+GENOME_NAME+suffix) for suffix in REQUIRED_SUFFIXES]):
+            mccutils.remove(entry)
+
+        if not os.path.exists(entry):
+            tmp_entry = entry[:-1]+".tmp/"
+            mccutils.remove(tmp_entry)
+            mccutils.mkdir(tmp_entry)
+            os.symlink(os.path.abspath(reference), tmp_entry+GENOME_NAME)
+
+            cwd = os.getcwd()
+            os.chdir(tmp_entry)
+            command = ["RepeatMasker","-pa", str(threads), "-lib", lib, "-dir", tmp_entry] + OPTIONS + [tmp_entry+GENOME_NAME]
+            completed = mccutils.run_command(command, log=log)
+            os.chdir(cwd)
+            if not completed:
+                sys.exit("ERROR: RepeatMasker failed on: "+reference+" with lib: "+lib+", check the log file: "+str(log)+"\n")
+
+            keep = [GENOME_NAME+suffix for suffix in OUTPUT_SUFFIXES]
+            for suffix in REQUIRED_SUFFIXES:
+                if not os.path.exists(tmp_entry+GENOME_NAME+suffix):
+                    sys.exit("can't find Repeatmasker output: "+GENOME_NAME+suffix+" in:"+tmp_entry+"\n")
+
+            for f in os.listdir(tmp_entry):
+                if f not in keep:
+                    mccutils.remove(tmp_entry+f)
+            os.rename(tmp_entry, entry)
+            mccutils.log("repeatmasker", "RepeatMasker output stored in: "+entry, log=log)
+        else:
+            mccutils.log("repeatmasker", "using RepeatMasker output from: "+entry, log=log)
+
+        mccutils.mkdir(out_dir)
+        ref_name = os.path.basename(reference)
+        for suffix in OUTPUT_SUFFIXES:
+            if suffix in REQUIRED_SUFFIXES or os.path.exists(entry+GENOME_NAME+suffix):
+                shutil.copyfile(entry+GENOME_NAME+suffix, out_dir+"/"+ref_name+suffix)
+        cache.touch(entry+cache.LAST_USED)
+
+    if max_size is not None:
+        cache.evict(store_dir, REPEATMASKER_STORE, max_size, keep=key, log=log)
+
+    return out_dir+"/"+ref_name+".out", out_dir+"/"+ref_name+".out.gff", out_dir+"/"+ref_name+".masked"
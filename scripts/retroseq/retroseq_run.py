@@ -22,6 +22,8 @@ def main():
     taxonomy = snakemake.input.taxonomy
     log = snakemake.params.log
     status_log = snakemake.params.status_log
+    # all: discover and call on the whole genome, discover/call: the steps of a --scatter run
+    mode = snakemake.params.get("mode", "all")
 
     try:
         with open(log,"a") as l:
@@ -40,13 +42,25 @@ def main():
         for f in os.listdir(out_dir):
             mccutils.remove(out_dir+"/"+f)
 
-        mccutils.log("retroseq","running RetroSeq", log=log)    
+        if mode == "call":
+            if not mccutils.check_status_file(snakemake.params.discover_status):
+                raise Exception("RetroSeq discovery failed, unable to call shard: "+snakemake.wildcards.shard)
 
-        elements = split_consensus_fasta(consensus_fasta, ref_name, out_dir)
+            mccutils.log("retroseq","running RetroSeq calling for shard: "+snakemake.wildcards.shard, log=log)
+            chromosomes = mccutils.get_chromosomes(snakemake.params.shard)
+            run_retroseq_call_regions(bam, snakemake.input.discovery, snakemake.input.locations, ref_fasta, script_dir, chromosomes, snakemake.output[0], out_dir, config.PARAMS, log=log)
 
-        bed_location_file = make_consensus_beds(elements, ref_name, ref_te_bed, taxonomy, out_dir)
+        else:
+            mccutils.log("retroseq","running RetroSeq", log=log)
 
-        run_retroseq(bam, bed_location_file, ref_fasta, script_dir, sample_name, out_dir, config.PARAMS, log=log)
+            elements = split_consensus_fasta(consensus_fasta, ref_name, out_dir)
+
+            bed_location_file = make_consensus_beds(elements, ref_name, ref_te_bed, taxonomy, out_dir)
+
+            discovery_out = run_retroseq_discover(bam, bed_location_file, script_dir, sample_name, out_dir, config.PARAMS, log=log)
+
+            if mode == "all":
+                run_retroseq_call(bam, discovery_out, bed_location_file, ref_fasta, script_dir, out_dir+"/"+sample_name+".call", config.PARAMS, log=log)
 
         with open(status_log,"w") as l:
             l.write("COMPLETED\n")
@@ -62,7 +76,8 @@ def main():
         with open(status_log,"w") as l:
             l.write("FAILED\n")
         
-        mccutils.run_command(["touch", snakemake.output[0]])
+        for out_file in snakemake.output:
+            mccutils.run_command(["touch", out_file])
 
 
 
@@ -131,7 +146,7 @@ def make_consensus_beds(elements, ref_name, te_bed, taxon, out):
     return location_file
     
 
-def run_retroseq(bam, bed_locations, ref_fasta, script_dir, sample_name, out_dir, params, log=None):
+def run_retroseq_discover(bam, bed_locations, script_dir, sample_name, out_dir, params, log=None):
     discovery_out = out_dir+"/"+sample_name+".discovery"
     command = ["perl", script_dir+"/retroseq.pl", 
                     "-discover",  
@@ -144,7 +159,10 @@ def run_retroseq(bam, bed_locations, ref_fasta, script_dir, sample_name, out_dir
         command.append(str(params[param]))
     mccutils.run_command(command, log=log)
 
-    call_out  = out_dir+"/"+sample_name+".call"
+    return discovery_out
+
+
+def run_retroseq_call(bam, discovery_out, bed_locations, ref_fasta, script_dir, call_out, params, region=None, log=None):
     command = ["perl", script_dir+"/retroseq.pl", 
                     "-call", 
                     "-bam", bam, 
@@ -154,11 +172,26 @@ def run_retroseq(bam, bed_locations, ref_fasta, script_dir, sample_name, out_dir
                     "-output", call_out, 
                     "-orientate", "yes"]
 
+    if region is not None:
+        command += ["-region", region]
+
     for param in params.keys():
         command.append(param)
         command.append(str(params[param]))
 
     mccutils.run_command(command, log=log)
+
+
+def run_retroseq_call_regions(bam, discovery_out, bed_locations, ref_fasta, script_dir, chromosomes, call_out, out_dir, params, log=None):
+    # one call per chromosome of the shard, merged into a single VCF
+    region_calls = []
+    for chrom, length in chromosomes.items():
+        region_call = out_dir+"/"+chrom+".call"
+        run_retroseq_call(bam, discovery_out, bed_locations, ref_fasta, script_dir, region_call, params, region=chrom+":1-"+str(length), log=log)
+        if os.path.exists(region_call):
+            region_calls.append((region_call, None))
+
+    mccutils.merge_shard_files(region_calls, call_out)
     
 
             
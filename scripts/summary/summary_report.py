@@ -9,6 +9,7 @@ from datetime import datetime
 from jinja2 import Environment, FileSystemLoader
 import traceback
 import json
+import numpy as np
 
 templateLoader = FileSystemLoader(searchpath=snakemake.config['args']['mcc_path']+"/templates/html/")
 env = Environment(loader=templateLoader)
@@ -61,7 +62,7 @@ def main():
     execution_dir = snakemake.params.execution_dir
     start_time = snakemake.params.time
     raw_fq2 = snakemake.params.raw_fq2
-    chromosomes = snakemake.params.chromosomes.split(",")
+    chromosomes = list(mccutils.get_chromosomes(snakemake.params.chromosomes))
     out_dir = snakemake.params.out_dir
     run_config = snakemake.params.run_config
     log_dir = snakemake.params.log_dir
@@ -105,6 +106,7 @@ def main():
         make_families_page(env, consensus, methods, out_file_map, out_dir)
         make_family_pages(env, consensus, methods, out_file_map, chromosomes, out_dir)
         make_method_pages(env, methods, consensus, out_file_map, chromosomes, out_dir)
+        make_performance_page(env, methods, sample_name, log_dir, out_dir, snakemake.output.html_performance_report)
 
     except Exception as e:
         track = traceback.format_exc()
@@ -168,7 +170,7 @@ def make_te_csv(methods, out_file_map, taxonomy, out_csv):
     for x,te_name in enumerate(te_names):
         te_counts[te_name] = {}
         for method in config.ALL_METHODS:
-            if "nonredundant.bed" in out_file_map[method]:
+            if "nonredundant.bed" in config.OUT_PATHS[method]:
                 if method in methods:
                     te_counts[te_name][method] = [0,0]
                 else:
@@ -210,7 +212,7 @@ def make_te_csv(methods, out_file_map, taxonomy, out_csv):
         for te in te_names:
             line = [te.replace(",","_")]
             for method in config.ALL_METHODS:
-                if "nonredundant.bed" in out_file_map[method]:
+                if "nonredundant.bed" in config.OUT_PATHS[method]:
                     if method in methods:
                         line += [str(te_counts[te][method][0]+te_counts[te][method][1]), str(te_counts[te][method][0]), str(te_counts[te][method][1])]
                     else:
@@ -269,12 +271,9 @@ def make_run_summary(out_file_map, commit, methods, failed_methods, fq1, fq2, re
                     out_lines.append(pad("read1 reads:",24) + str(reads) + "\n")
 
             
-        with open(median_insert_size,"r") as median_insert:
-            for line in median_insert:
-                line = line.split("=")[1].replace("\n","")
-                insert_size = str(int(float(line)))
-                mapping_info["median_insert_size"] = insert_size
-                out_lines.append(pad("median insert size:",24) + insert_size + "\n")
+        insert_size = str(mccutils.get_median_insert_size(median_insert_size))
+        mapping_info["median_insert_size"] = insert_size
+        out_lines.append(pad("median insert size:",24) + insert_size + "\n")
         
         avg_genome_cov = str(get_avg_coverage(ref, bam, out_dir))
         mapping_info['avg_genome_cov'] = avg_genome_cov
@@ -298,7 +297,7 @@ def make_run_summary(out_file_map, commit, methods, failed_methods, fq1, fq2, re
     out_lines.append(pad("METHOD", width1) + pad("ALL",width2) + pad("REFERENCE",width3) + pad("NON-REFERENCE", width4) + "\n")
     out_lines.append("-"*(width1) + "-"*width2 + "-"*width3 + "-"*width4 + "\n")
     for method in config.ALL_METHODS:
-        if "nonredundant.bed" in out_file_map[method]:
+        if "nonredundant.bed" in config.OUT_PATHS[method]:
             if method in methods:
                 all_te, ref_te, nonref_te = get_te_counts(out_file_map[method])
                 out_lines.append(pad(method, width1) + pad(str(all_te), width2) + pad(str(ref_te), width3) + pad(str(nonref_te), width4) + "\n")
@@ -341,7 +340,7 @@ def get_avg_coverage(ref, bam, out):
         chrom.append(str(record.id))
     
     tmp = out+"/tmp"
-    command = ['samtools','depth',bam]
+    command = ['samtools','depth'] + mccutils.reference_args(bam, ref) + [bam]
     mccutils.run_command_stdout(command, tmp)
 
     cov_total = 0
@@ -385,13 +384,11 @@ def make_data_copies(methods, results_dir, out_dir):
         for f in os.listdir(results_dir+"/coverage/"):
             if not os.path.isdir(results_dir+"/coverage/"+f):
                 mccutils.run_command(["cp", results_dir+"/coverage/"+f, out_dir+"/data/coverage/"])
-        for f in os.listdir(results_dir+"/coverage/te-depth-files/"):
-            mccutils.run_command(["cp", results_dir+"/coverage/te-depth-files/"+f, out_dir+"/data/coverage/"])
         for f in os.listdir(out_dir+"/data/coverage/"):
-            tmp = out_dir+"/data/coverage/"+f
-            o = f.replace(".csv",".txt")
-            o = o.replace(".cov",".txt")
-            mccutils.run_command(["mv", tmp, out_dir+"/data/coverage/"+o])
+            if ".csv" in f:
+                tmp = out_dir+"/data/coverage/"+f
+                o = f.replace(".csv",".txt")
+                mccutils.run_command(["mv", tmp, out_dir+"/data/coverage/"+o])
 
 def read_trimgalore_results(fastq, trimgalore_dir):
     results = ["","","","","",""]
@@ -561,6 +558,94 @@ def make_summary_page(jinja_env, methods, sample_name, commit, start_time, end_t
             out.write(line)
 
 
+def read_benchmarks(benchmark_dir):
+    rules = []
+    if not os.path.exists(benchmark_dir):
+        return rules
+
+    for f in sorted(os.listdir(benchmark_dir)):
+        if f[-4:] != ".tsv":
+            continue
+
+        with open(benchmark_dir+"/"+f, "r") as tsv:
+            header = tsv.readline().replace("\n","").split("\t")
+            values = []
+            for line in tsv:
+                # rules benchmarked more than once keep the last measurement
+                values = line.replace("\n","").split("\t")
+
+        if len(values) != len(header):
+            continue
+
+        benchmark = dict(zip(header, values))
+        rules.append({
+            "rule": f[:-4],
+            "wall_time_s": benchmark_value(benchmark, "s"),
+            "cpu_time_s": benchmark_value(benchmark, "cpu_time"),
+            "max_rss_mb": benchmark_value(benchmark, "max_rss"),
+            "io_in_mb": benchmark_value(benchmark, "io_in"),
+            "io_out_mb": benchmark_value(benchmark, "io_out"),
+            "mean_load": benchmark_value(benchmark, "mean_load")
+        })
+
+    return rules
+
+def benchmark_value(benchmark, key):
+    try:
+        return round(float(benchmark[key]), 2)
+    except (KeyError, ValueError):
+        return None
+
+def make_performance_page(jinja_env, methods, sample_name, log_dir, out_dir, out_file):
+    template = jinja_env.get_template('performance.html')
+
+    rules = read_benchmarks(log_dir+"/benchmark/")
+    rules.sort(key=lambda rule: rule['wall_time_s'] if rule['wall_time_s'] is not None else 0, reverse=True)
+
+    total_wall_time = 0
+    total_cpu_time = 0
+    for rule in rules:
+        if rule['wall_time_s'] is not None:
+            total_wall_time += rule['wall_time_s']
+        if rule['cpu_time_s'] is not None:
+            total_cpu_time += rule['cpu_time_s']
+
+    performance = {
+        "sample": sample_name,
+        "total_wall_time_s": round(total_wall_time, 2),
+        "total_cpu_time_s": round(total_cpu_time, 2),
+        "rules": rules
+    }
+
+    mccutils.mkdir(out_dir+"/data/")
+    mccutils.mkdir(out_dir+"/data/run/")
+    with open(out_dir+"/data/run/performance.json", "w") as out:
+        json.dump(performance, out, indent=4)
+
+    prediction_methods = []
+    for method in methods:
+        if method not in NO_PRED_METHODS:
+            prediction_methods.append(method)
+
+    coverage = None
+    if "coverage" in methods:
+        coverage = True
+
+    rendered_lines = template.render(
+        sample=sample_name,
+        prediction_methods=prediction_methods,
+        coverage=coverage,
+        rules=rules,
+        total_wall_time_s=performance['total_wall_time_s'],
+        total_cpu_time_s=performance['total_cpu_time_s'],
+        plot_height=max(300, len(rules)*25)
+    )
+
+    with open(out_file,"w") as out:
+        for line in rendered_lines:
+            out.write(line)
+
+
 def make_families_page(jinja_env, consensus, methods, out_file_map, out_dir):
     template = jinja_env.get_template('families.html')
 
@@ -604,6 +689,20 @@ def make_families_page(jinja_env, consensus, methods, out_file_map, out_dir):
                 out.write(line)
 
 
+def read_coverage(npz_file):
+    # normalized (MAPQ >= 0, MAPQ > 0) depths of each family, sliced from the coverage container
+    coverage = {}
+    with np.load(npz_file) as data:
+        offsets = data["offsets"]
+        genome_depth = float(data["genome_depth"])
+        all_depths = data["allQ"]/genome_depth
+        uniq_depths = data["highQ"]/genome_depth
+        for x, family in enumerate(data["families"].tolist()):
+            coverage[family] = (all_depths[offsets[x]:offsets[x+1]], uniq_depths[offsets[x]:offsets[x+1]])
+
+    return coverage
+
+
 def make_family_pages(jinja_env, consensus, methods, out_file_map, chromosomes, out_dir):
 
     prediction_methods = []
@@ -627,7 +726,9 @@ def make_family_pages(jinja_env, consensus, methods, out_file_map, chromosomes,
 
 
         depth = {}
+        coverage = {}
         if "coverage" in methods:
+            coverage = read_coverage(out_dir+"/data/coverage/te_depth.npz")
             with open(out_dir+"/data/coverage/te_depth.txt","r") as depth_file:
                 for i,line in enumerate(depth_file):
                     if i > 0:
@@ -644,23 +745,11 @@ def make_family_pages(jinja_env, consensus, methods, out_file_map, chromosomes,
             template = jinja_env.get_template('family.html')
 
             if "coverage" in methods:
-                all_pos = []
-                all_cov = []
-                with open(out_dir+"data/coverage/"+family+".allQ.normalized.txt","r") as data:
-                    for line in data:
-                        line = line.replace("\n","")
-                        split_line = line.split("\t")
-                        all_pos.append(split_line[1])
-                        all_cov.append(split_line[2])
-                
-                uniq_pos = []
-                uniq_cov = []
-                with open(out_dir+"data/coverage/"+family+".highQ.normalized.txt","r") as data:
-                    for line in data:
-                        line = line.replace("\n","")
-                        split_line = line.split("\t")
-                        uniq_pos.append(split_line[1])
-                        uniq_cov.append(split_line[2])
+                all_norm_depths, uniq_norm_depths = coverage[family]
+                all_pos = [str(pos) for pos in range(1, len(all_norm_depths)+1)]
+                all_cov = [str(round(d,2)) for d in all_norm_depths.tolist()]
+                uniq_pos = all_pos
+                uniq_cov = [str(round(d,2)) for d in uniq_norm_depths.tolist()]
 
             prediction = count_predictions(prediction_methods, out_file_map, family)
             family_prediction_summary_file = out_dir+"/data/families/"+family+"_prediction_summary.txt"
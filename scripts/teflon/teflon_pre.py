@@ -4,6 +4,7 @@ import subprocess
 import traceback
 sys.path.append(snakemake.config['args']['mcc_path'])
 import scripts.mccutils as mccutils
+import scripts.cache as cache
 
 def main():
     mccutils.log("teflon","setting up for TEFLoN")
@@ -104,8 +105,15 @@ def prep_annotations(script_dir, out_dir, ref_bed, taxonomy, consensus, referenc
 
 def map_reads(out_dir, fq1, fq2, threads=1, log=None):
     reference_genome = out_dir+"/teflon.prep_MP/teflon.mappingRef.fa"
+    sorted_bam = out_dir+"teflon.sorted.bam"
+    cache_dir = snakemake.config['args']['cache']
+    if cache_dir != "None":
+        key = cache.get_alignment_key(reference_genome, [fq1, fq2], ["bwa", "mem", "-Y"], env=snakemake.config['envs']['teflon'])
+        if cache.restore_alignments(cache_dir, key, [sorted_bam, sorted_bam+".bai"], log=log):
+            return sorted_bam
+
     command = ["bwa", "index", reference_genome]
-    mccutils.run_command(command, log=log)
+    cache.get_index(cache_dir, reference_genome, "bwa", cache.get_index_files("bwa", reference_genome), [command], log=log)
 
     out_sam = out_dir+"teflon.sam"
 
@@ -117,22 +125,30 @@ def map_reads(out_dir, fq1, fq2, threads=1, log=None):
         fq2
     ]
 
-    mccutils.run_command_stdout(command, out_sam, log=log)
+    if not mccutils.run_command_stdout(command, out_sam, log=log):
+        raise subprocess.CalledProcessError(1, command)
 
     out_bam = out_dir+"teflon.bam"
     command = ["samtools", "view", "-Sb", out_sam]
-    mccutils.run_command_stdout(command, out_bam, log=log)
+    if not mccutils.run_command_stdout(command, out_bam, log=log):
+        raise subprocess.CalledProcessError(1, command)
 
-    sorted_bam = out_dir+"teflon.sorted.bam"
     command = ["samtools", "sort", "-@", str(threads), "-o", sorted_bam, out_bam]
-    mccutils.run_command(command, log=log)
+    if not mccutils.run_command(command, log=log):
+        raise subprocess.CalledProcessError(1, command)
 
     command = ["samtools", "index", sorted_bam ]
-    mccutils.run_command(command, log=log)
+    if not mccutils.run_command(command, log=log):
+        raise subprocess.CalledProcessError(1, command)
 
     mccutils.remove(out_sam)
     mccutils.remove(out_bam)
 
+    mccutils.check_file_exists(sorted_bam)
+    mccutils.check_file_exists(sorted_bam+".bai")
+    if cache_dir != "None":
+        cache.store_alignments(cache_dir, key, [sorted_bam, sorted_bam+".bai"], max_size=snakemake.config['args']['cache_max_size'], log=log)
+
     return sorted_bam
 
 
@@ -19,7 +19,7 @@ def main():
     reference_fasta = snakemake.input.reference_fasta
     log = snakemake.params.log
     sample_name = snakemake.params.sample_name
-    chromosomes = snakemake.params.chromosomes.split(",")
+    chromosomes = mccutils.get_chromosomes(snakemake.params.chromosomes)
     out_dir = snakemake.params.out_dir
     status_log = snakemake.params.status_log
     vcf_options = snakemake.params.vcf.split(",")
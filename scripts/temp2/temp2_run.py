@@ -43,7 +43,7 @@ def main():
     mccutils.log("temp2","running TEMP2 Module")
 
     try:
-        median_insert_size = get_median_insert_size(median_insert_size_file)
+        median_insert_size = mccutils.get_median_insert_size(median_insert_size_file)
         run_temp2_insertion(fq1, fq2, bam, median_insert_size, reference, script_dir, consensus, ref_te_bed, threads, out_dir, config, log)
         run_temp2_absence(script_dir, bam, twobit, ref_te_bed, median_insert_size, threads, out_dir+"/absence", config, log)
         mccutils.run_command(["cp", out_dir+'/absence/'+sample_name+".absence.refined.bp.summary", out_dir], log=log)
@@ -67,16 +67,6 @@ def main():
         mccutils.run_command(["touch", snakemake.output[1]])
 
 
-def get_median_insert_size(infile):
-    median_insert_size = 0
-    with open(infile,"r") as inf:
-        for line in inf:
-            insert = line.split("=")[1]
-            insert = insert.replace("\n","")
-            median_insert_size = int(float(insert))
-    
-    return median_insert_size
-
 def run_temp2_insertion(fq1, fq2, bam, insert_size, reference, scripts, consensus, te_bed, threads, out, config, log):
     mccutils.log("temp2","running TEMP2 non-reference insertion prediction", log=log)
     command = [
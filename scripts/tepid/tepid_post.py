@@ -20,7 +20,7 @@ def main():
     te_taxonomy = snakemake.input.te_taxonomy
     reference_fasta = snakemake.input.reference_fasta
 
-    chromosomes = snakemake.params.chromosomes.split(",")
+    chromosomes = mccutils.get_chromosomes(snakemake.params.chromosomes)
     status_log = snakemake.params.status_log
 
     sample_name = snakemake.params.sample_name
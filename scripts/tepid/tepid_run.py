@@ -9,6 +9,7 @@ sys.modules[spec.name] = config
 spec.loader.exec_module(config)
 sys.path.append(snakemake.config['args']['mcc_path'])
 import scripts.mccutils as mccutils
+import scripts.cache as cache
 
 def main():
     ref_fasta = snakemake.input.ref_fasta
@@ -32,26 +33,39 @@ def main():
         for f in os.listdir(out_dir):
             mccutils.remove(out_dir+"/"+f)
 
-        median_insert_size = ""
-        with open(median_insert_size_file,"r") as median_insert:
-            for line in median_insert:
-                line = line.split("=")[1].replace("\n","")
-                median_insert_size = line
+        median_insert_size = str(mccutils.get_median_insert_size(median_insert_size_file))
 
         is_paired = True
         if raw_fq2 == "False":
             is_paired = False
         
-        mccutils.log("tepid","indexing reference", log=log)
-        index_ref(ref_fasta, ref_name, out_dir, log=log)
+        bam = out_dir+"/"+ref_name+".bam"
+        split_bam = out_dir+"/"+ref_name+".split.bam"
+        alignments = [bam, bam+".bai", split_bam, split_bam+".bai"]
+        cache_dir = snakemake.config['args']['cache']
+        if cache_dir != "None":
+            if is_paired:
+                key = cache.get_alignment_key(ref_fasta, [fq1, fq2], ["tepid-map", "-s", median_insert_size, "-n", ref_name], env=snakemake.config['envs']['tepid'])
+            else:
+                key = cache.get_alignment_key(ref_fasta, [fq1], ["tepid-map-se", "-n", ref_name], env=snakemake.config['envs']['tepid'])
+
         mccutils.log("tepid","making TEPID reference TE bed")
         te_bed = make_te_bed(te_gff, te_taxonomy, out_dir)
 
-        mccutils.log("tepid","mapping reads", log=log)
-        if is_paired:
-            bam, split_bam = map_reads(fq1, fq2, ref_name, median_insert_size, out_dir, threads=threads, paired=True, log=log)
-        else:
-            bam, split_bam = map_reads(fq1, fq2, ref_name, median_insert_size, out_dir, threads=threads, paired=False, log=log)
+        if cache_dir == "None" or not cache.restore_alignments(cache_dir, key, alignments, log=log):
+            mccutils.log("tepid","indexing reference", log=log)
+            index_ref(ref_fasta, ref_name, out_dir, log=log)
+
+            mccutils.log("tepid","mapping reads", log=log)
+            if is_paired:
+                bam, split_bam = map_reads(fq1, fq2, ref_name, median_insert_size, out_dir, threads=threads, paired=True, log=log)
+            else:
+                bam, split_bam = map_reads(fq1, fq2, ref_name, median_insert_size, out_dir, threads=threads, paired=False, log=log)
+
+            if cache_dir != "None":
+                for f in alignments:
+                    mccutils.check_file_exists(f)
+                cache.store_alignments(cache_dir, key, alignments, max_size=snakemake.config['args']['cache_max_size'], log=log)
 
         mccutils.log("tepid","discovering variants", log=log)
         discover_variants(ref_name, bam, split_bam, te_bed, out_dir, threads=threads, log=log)
@@ -76,10 +90,11 @@ def index_ref(fasta, ref_name, out, log=None):
         os.chdir(out)
         fasta_no_path = fasta.split("/")[-1]
         fasta_copy = out+"/"+fasta_no_path
-        mccutils.run_command(["cp", fasta, fasta_copy])
+        prefix = out+"/"+ref_name
+        cache_dir = snakemake.config['args']['cache']
 
-        mccutils.run_command(["bowtie2-build", fasta_copy, ref_name], log=log)
-        mccutils.run_command(["yaha", "-g", fasta_copy], log=log)
+        cache.get_index(cache_dir, fasta, "bowtie2", cache.get_index_files("bowtie2", prefix), [["bowtie2-build", fasta, prefix]], log=log)
+        cache.get_index(cache_dir, fasta, "yaha", cache.get_index_files("yaha", prefix), [["cp", fasta, fasta_copy], ["yaha", "-g", fasta_copy]], log=log)
 
         mccutils.check_file_exists(out+"/"+ref_name+".X15_01_65525S")
     
@@ -137,7 +152,8 @@ def map_reads(fq1, fq2, ref_name, median_insert_size, out, threads=1, paired=Tru
                         "-n", ref_name,
                         "-q", fq1]
 
-    mccutils.run_command(command, log=log)
+    if not mccutils.run_command(command, log=log):
+        raise subprocess.CalledProcessError(1, command)
 
     bam = out+"/"+ref_name+".bam"
     split_bam = out+"/"+ref_name+".split.bam"